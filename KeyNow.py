@@ -1,257 +1,2179 @@
 import os
+import atexit
 import json
 import sqlite3
+import gzip
+import queue
+import shutil
 import logging
 import asyncio
+import threading
+import contextvars
+import time
+import uuid
+import socket
+import random
+import functools
+import weakref
 import httpx
+from bisect import bisect_left, bisect_right
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from flask import Flask, request, jsonify
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.events import EVENT_JOB_MISSED
+try:
+    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore  # SQLAlchemyが必要
+except ImportError:
+    SQLAlchemyJobStore = None
+try:
+    import numpy as np  # 任意。利用統計の集計に使う(無ければPythonで同じ計算をする)
+except ImportError:
+    np = None
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from pydrive.auth import GoogleAuth
 from pydrive.drive import GoogleDrive
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, timedelta, time as dtime
+
+#設定ファイル
+config = json.load(open("line.json", encoding="utf-8"))
 
 #ログ設定###############################################################################################################あ
-logging.basicConfig(
-    filename="keynow.log",
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    datefmt="%Y/%m/%d %H:%M:%S"
-)
+#ログは呼び出し元ではキューに積むだけで、ファイルへの書き込み・JSON化・ローテーション・圧縮は専用スレッドで行う
+LOG_LEVEL = config.get("log_level", "INFO")
+LOG_MAX_BYTES = int(config.get("log_max_bytes", 10 * 1024 * 1024))#これを超えたらローテーション
+LOG_ROTATE_HOURS = float(config.get("log_rotate_hours", 24))#最低でもこの間隔でローテーション(0で無効)
+LOG_BACKUP_COUNT = int(config.get("log_backup_count", 14))#残す世代数(.1.gz 〜)
+LOG_MAX_CHARS = int(config.get("log_max_chars", 4000))#1レコードのメッセージ上限
+LOG_SNIPPET_CHARS = int(config.get("log_snippet_chars", 300))#本文・送信メッセージなど大きな引数の上限
+LOG_PAYLOAD_SAMPLE_RATE = float(config.get("log_payload_sample_rate", 0.01))#Webhook本文をINFOで残す割合
+
+#相関ID(Webhookの受信ごと / イベントごと)。ログレコードに自動で付く
+log_request_id = contextvars.ContextVar("log_request_id", default=None)
+log_event_id = contextvars.ContextVar("log_event_id", default=None)
+
+#大きな値は出力時にだけ文字列化して切り詰める(ログレベルで捨てられた時は何もしない)
+class LogSnippet:
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = limit or LOG_SNIPPET_CHARS
+
+    def __str__(self):
+        text = self.value if isinstance(self.value, str) else json.dumps(self.value, ensure_ascii=False, default=str)
+        if len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}...(+{len(text) - self.limit}文字)"
+
+class CorrelationFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = log_request_id.get()
+        record.event_id = log_event_id.get()
+        return True
+
+#RotatingFileHandler はサイズ判定でも format を呼ぶので、1レコード1回だけ組み立てて使い回す
+class JsonLineFormatter(logging.Formatter):
+    def format(self, record):
+        line = getattr(record, "json_line", None)
+        if line is None:
+            line = record.json_line = self._format(record)
+        return line
+
+    def _format(self, record):
+        message = record.getMessage()
+        if len(message) > LOG_MAX_CHARS:
+            message = f"{message[:LOG_MAX_CHARS]}...(+{len(message) - LOG_MAX_CHARS}文字)"
+        entry = {
+            "ts": f"{self.formatTime(record, '%Y/%m/%d %H:%M:%S')}.{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": message,
+        }
+        for field in ("request_id", "event_id"):
+            value = getattr(record, field, None)
+            if value:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def _gzip_rotator(source, dest):
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+#サイズと経過時間の両方でローテーションし、古い世代は gzip で圧縮する
+class CompressingRotatingFileHandler(RotatingFileHandler):
+    def __init__(self, filename, max_bytes, backup_count, rotate_hours):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.rotate_seconds = rotate_hours * 3600
+        self.namer = lambda name: f"{name}.gz"
+        self.rotator = _gzip_rotator
+        self.next_rollover = self._next_rollover()
+
+    def _next_rollover(self):
+        return time.time() + self.rotate_seconds if self.rotate_seconds > 0 else float("inf")
+
+    def shouldRollover(self, record):
+        if time.time() >= self.next_rollover and os.path.exists(self.baseFilename) \
+                and os.path.getsize(self.baseFilename) > 0:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.next_rollover = self._next_rollover()
+
+#logger名で振り分け(apscheduler は scheduler.log、それ以外は keynow.log)
+class LoggerNameFilter(logging.Filter):
+    def __init__(self, prefix, include):
+        super().__init__()
+        self.prefix = prefix
+        self.include = include
+
+    def filter(self, record):
+        return record.name.startswith(self.prefix) == self.include
+
+def _log_file_handler(filename, include_scheduler):
+    handler = CompressingRotatingFileHandler(filename, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_HOURS)
+    handler.setFormatter(JsonLineFormatter())
+    handler.addFilter(LoggerNameFilter("apscheduler", include_scheduler))
+    return handler
+
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, _log_file_handler("keynow.log", False),
+                             _log_file_handler("scheduler.log", True))
+
+#既定の QueueHandler.prepare は呼び出し元のスレッドでメッセージを組み立てる(LogSnippet の文字列化も)ので、
+#レコードをそのまま積んで整形は書き込みスレッドだけで行う(相関IDはフィルタで積む前に付ける)
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        return record
+
+def _queue_handler():
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(CorrelationFilter())
+    return handler
+
+logging.root.setLevel(LOG_LEVEL)
+logging.root.addHandler(_queue_handler())
 logger = logging.getLogger(__name__)
-logger.info("Starting KeyNow bot")
 
-#スケジューラー用ログ上書き
+#スケジューラー用ログ(scheduler.log に分ける)
 aps_logger = logging.getLogger("apscheduler")
-aps_handler = logging.FileHandler("scheduler.log", encoding="utf-8")
-aps_handler.setFormatter(logging.Formatter(
-    "%(asctime)s [%(levelname)s] %(message)s", datefmt="%Y/%m/%d %H:%M:%S"
-))
 aps_logger.setLevel(logging.INFO)
-aps_logger.addHandler(aps_handler)
+aps_logger.addHandler(_queue_handler())
 aps_logger.propagate = False  # 親ロガーに流さない
 
+log_listener.start()
+atexit.register(log_listener.stop)  # 最初に登録して最後に実行(他の終了処理のログも書き切る)
+logger.info("Starting KeyNow bot")
+
+# メトリクス(Prometheus形式で GET /metrics に出す)#########################################################################
+#観測1回あたり perf_counter 2回とロック1回だけなので本番でも常時有効にしておく
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)#秒
+DB_METRICS_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0, 5.0)#秒
+
+metrics_registry = []
+
+def _metric_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+class MetricCounter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.values = {}  # ラベル値のタプル -> 値
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return [(self.name, _metric_labels(self.labels, values), value) for values, value in items]
+
+class MetricHistogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}  # ラベル値のタプル -> [各バケットの件数..., +Inf の件数, 合計秒]
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def observe(self, seconds, *label_values):
+        index = bisect_left(self.buckets, seconds)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+
+    def samples(self):
+        with self.lock:
+            items = [(values, list(series)) for values, series in self.series.items()]
+        samples = []
+        for values, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", _metric_labels(self.labels + ("le",), values + (bound,)), cumulative))
+            samples.append((f"{self.name}_sum", _metric_labels(self.labels, values), round(series[-1], 6)))
+            samples.append((f"{self.name}_count", _metric_labels(self.labels, values), cumulative))
+        return samples
+
+#出力時に値を読む(キュー深さや既存の統計dict用)。func は数値か {ラベル値のタプル: 数値} を返す
+class MetricCallback:
+    def __init__(self, name, help_text, func, labels=(), kind="gauge"):
+        self.name = name
+        self.help = help_text
+        self.func = func
+        self.labels = tuple(labels)
+        self.kind = kind
+        metrics_registry.append(self)
+
+    def samples(self):
+        value = self.func()
+        if not isinstance(value, dict):
+            return [(self.name, "", value)]
+        return [(self.name, _metric_labels(self.labels, values), v) for values, v in value.items()]
+
+def render_metrics():
+    lines = []
+    for metric in metrics_registry:
+        try:
+            samples = metric.samples()
+        except Exception as e:
+            logger.error("メトリクス取得失敗(%s): %s", metric.name, e)
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in samples)
+    return "\n".join(lines) + "\n"
+
+#with 内の処理時間を記録する(例外時は errors も数える)。コルーチン内でも await を挟んで使える
+@contextmanager
+def observe_time(histogram, *label_values, errors=None):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if errors is not None:
+            errors.inc(*label_values)
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - started, *label_values)
+
+command_seconds = MetricHistogram("keynow_command_duration_seconds", "コマンドの処理時間", ("command",))
+command_errors = MetricCounter("keynow_command_errors_total", "コマンドの例外数", ("command",))
+event_seconds = MetricHistogram("keynow_event_duration_seconds", "Webhook受信からイベント処理完了までの時間")
+line_request_seconds = MetricHistogram("keynow_line_request_duration_seconds", "LINE API呼び出し時間", ("endpoint",))
+line_requests = MetricCounter("keynow_line_requests_total", "LINE API呼び出し数(status=error は通信エラー)",
+                              ("endpoint", "status"))
+sheets_request_seconds = MetricHistogram("keynow_sheets_request_duration_seconds",
+                                         "Google Sheets/Drive呼び出し時間", ("call",))
+sheets_errors = MetricCounter("keynow_sheets_errors_total", "Google Sheets/Drive呼び出しの失敗数", ("call",))
+db_query_seconds = MetricHistogram("keynow_db_query_duration_seconds", "SQLiteの文の実行時間(fetchは含まない)",
+                                   ("op",), buckets=DB_METRICS_BUCKETS)
+db_lock_wait_seconds = MetricHistogram("keynow_db_lock_wait_seconds", "BEGIN IMMEDIATE の書き込みロック待ち時間",
+                                       buckets=DB_METRICS_BUCKETS)
+db_transaction_seconds = MetricHistogram("keynow_db_transaction_duration_seconds", "トランザクションの開始から確定まで",
+                                         buckets=DB_METRICS_BUCKETS)
+job_seconds = MetricHistogram("keynow_job_duration_seconds", "スケジューラジョブの実行時間", ("job",))
+job_errors = MetricCounter("keynow_job_errors_total", "スケジューラジョブの例外数", ("job",))
+job_misfires = MetricCounter("keynow_job_misfires_total", "実行時刻を逃したスケジューラジョブ数", ("job",))
+outbox_deliveries = MetricCounter("keynow_outbox_deliveries_total", "LINE送信キューの配信結果(sent/retry/fallback/dead)",
+                                  ("kind", "result"))
+outbox_delay_seconds = MetricHistogram("keynow_outbox_delay_seconds", "LINE送信キューに積んでから送信できるまでの時間", ("kind",))
+
+#スケジューラジョブの実行時間を記録するデコレータ
+def timed_job(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with observe_time(job_seconds, func.__name__, errors=job_errors):
+            return func(*args, **kwargs)
+    return wrapper
+
 #ログ履歴保管用(DB30day)
-def log_key_action(action, key_name, user_name):
-    now = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-    INSERT INTO key_logs (action, key_name, user_name, timestamp)
-    VALUES (?, ?, ?, ?)
-    """, (action, key_name, user_name, now))
-    conn.commit()
-    conn.close()
-    logger.info(f"Logged action: {action} - {key_name} by {user_name}")
-
-#ログ履歴送信
-async def send_history(reply_token: str):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    query = """
-    SELECT action, key_name, user_name, timestamp
+KEY_LOG_SQL = """
+INSERT INTO key_logs (action, key_name, user_name, timestamp, ts, holder_id)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+def key_log_params(action, key_name, user_name, holder_id=None):
+    ts = int(time.time())
+    return action, key_name, user_name, datetime.fromtimestamp(ts).strftime("%Y/%m/%d %H:%M:%S"), ts, holder_id
+
+#鍵操作(借りる・返却・引き継ぎ)の記録は KeyStateEngine が保有者の変更と同じトランザクションで書く
+def log_key_action(action, key_name, user_name, holder_id=None):
+    db_write(KEY_LOG_SQL, key_log_params(action, key_name, user_name, holder_id))
+    logger.info("Logged action: %s - %s by %s", action, key_name, user_name)
+
+#ログ履歴検索#############################################################################################################
+HISTORY_DAYS = 30#期間指定が無い時の検索範囲
+HISTORY_PAGE_ROWS = int(config.get("history_page_rows", 300))#1回の検索で読む最大行数
+
+#「履歴確認 鍵:音倉 ユーザー:山田 操作:借りる 期間:2025/04/01-2025/04/10 続き:<カーソル>」「履歴確認 集計」を解析
+def parse_history_args(args):
+    filters = {"key": None, "user": None, "action": None, "since": None, "until": None,
+               "cursor": None, "summary": False}
+    for arg in args:
+        arg = arg.replace("：", ":")
+        if arg == "集計":
+            filters["summary"] = True
+            continue
+        name, sep, value = arg.partition(":")
+        if not sep or not value:
+            raise ValueError(f"引数を解釈できません: {arg}")
+        if name == "鍵":
+            keys, _ = key_registry.resolve([value])
+            filters["key"] = "・".join(keys) or value
+        elif name == "ユーザー":
+            filters["user"] = value
+        elif name == "操作":
+            filters["action"] = value
+        elif name in ("期間", "日付"):
+            start, _, end = value.partition("-")
+            try:
+                since = datetime.strptime(start, "%Y/%m/%d")
+                until = datetime.strptime(end, "%Y/%m/%d") if end else since
+            except ValueError:
+                raise ValueError(f"期間は 年/月/日-年/月/日 の形で指定してください: {value}") from None
+            filters["since"] = int(since.timestamp())
+            filters["until"] = int((until + timedelta(days=1)).timestamp())
+        elif name == "続き":
+            ts, _, row_id = value.partition("-")
+            if not ts.isdigit() or not row_id.isdigit():
+                raise ValueError(f"続きは前の返信の末尾に書かれたものをそのまま付けてください: {value}")
+            filters["cursor"] = (int(ts), int(row_id))
+        else:
+            raise ValueError(f"不明な条件です: {name}")
+    if filters["since"] is None:
+        filters["since"] = int(time.time()) - HISTORY_DAYS * 86400
+    return filters
+
+def _history_where(filters):
+    clauses = ["ts >= ?"]
+    params = [filters["since"]]
+    if filters["until"] is not None:
+        clauses.append("ts < ?")
+        params.append(filters["until"])
+    # 複数の鍵をまとめた操作は「音倉・音練」のように記録されているので、含まれていれば一致とする
+    if filters["key"]:
+        clauses.append("('・' || key_name || '・') LIKE ?")
+        params.append(f"%・{filters['key']}・%")
+    for column, name in (("user_name", "user"), ("action", "action")):
+        if filters[name]:
+            clauses.append(f"{column} = ?")
+            params.append(filters[name])
+    return " AND ".join(clauses), params
+
+#キーセットページングで1ページ分を取得(ts, id の降順)
+def query_history(filters, limit=HISTORY_PAGE_ROWS):
+    where, params = _history_where(filters)
+    if filters["cursor"]:
+        where += " AND (ts, id) < (?, ?)"
+        params.extend(filters["cursor"])
+    c = get_db_connection().cursor()
+    c.execute(f"""
+    SELECT id, ts, action, key_name, user_name
     FROM key_logs
-    WHERE timestamp >= datetime('now', '-30 day')
-    ORDER BY timestamp DESC
-    """
-    c.execute(query)
-    rows = c.fetchall()
-    conn.close()
-
+    WHERE {where}
+    ORDER BY ts DESC, id DESC
+    LIMIT ?
+    """, (*params, limit))
+    return c.fetchall()
+
+#日別・鍵別・操作別の件数
+def query_history_summary(filters):
+    where, params = _history_where(filters)
+    c = get_db_connection().cursor()
+    c.execute(f"""
+    SELECT strftime('%Y/%m/%d', ts, 'unixepoch', 'localtime') AS day, key_name, action, COUNT(*)
+    FROM key_logs
+    WHERE {where}
+    GROUP BY day, key_name, action
+    ORDER BY day DESC, key_name, action
+    """, params)
+    return c.fetchall()
+
+#行をLINEの文字数制限に収まるよう最大5通に詰める。収まった行数を返す
+def pack_lines(lines, header="", reserve=0):
+    messages = []
+    current = header
+    packed = 0
+    for line in lines:
+        candidate = f"{current}\n{line}" if current else line
+        limit = LINE_TEXT_LIMIT - (reserve if len(messages) == LINE_MAX_MESSAGES - 1 else 0)
+        if len(candidate) <= limit:
+            current = candidate
+        else:
+            if len(messages) == LINE_MAX_MESSAGES - 1:
+                break
+            messages.append(current)
+            current = line[:LINE_TEXT_LIMIT]
+        packed += 1
+    if current:
+        messages.append(current)
+    return messages, packed
+
+def build_history_messages(filters):
+    if filters["summary"]:
+        rows = query_history_summary(filters)
+        if not rows:
+            return ["指定条件の操作履歴はありません。"]
+        lines = [f"{day} {key_name} {action}: {count}件" for day, key_name, action, count in rows]
+        messages, packed = pack_lines(lines, header="履歴集計(日別・鍵別):", reserve=40)
+        if packed < len(lines):
+            messages[-1] += f"\n…ほか {len(lines) - packed} 行(期間を絞ってください)"
+        return messages
+
+    rows = query_history(filters)
     if not rows:
-        reply = "過去30日間の操作履歴はありません。"
-    else:
-        logs = [f"{row[3]} - {row[1]}: {row[2]} が {row[0]}" for row in rows]
-        reply = "過去30日間の履歴:\n" + "\n".join(logs)
-
-    await send_line_message(reply_token, reply)
-
-
-#Google Sheets 認証######################################################################################################
-try:
-    scope = [
-        "https://spreadsheets.google.com/feeds",
-        "https://www.googleapis.com/auth/drive"
-    ]
-    creds = ServiceAccountCredentials.from_json_keyfile_name("GCOA.json", scope)
-    client = gspread.authorize(creds)
-    logger.info("Google Sheets 認証成功")
-
-    # シート指定と確認
-    debt_spreadsheet = client.open("名簿DB")
-    sheet1 = debt_spreadsheet.worksheet("名簿")
-    logger.info("シート '名簿' に正常にアクセスしました")
-
-    reserve_spreadsheet = client.open("KeyNow")
-    sheet2 = reserve_spreadsheet.worksheet("予約")
-    logger.info("シート '予約' に正常にアクセスしました")
-
-except Exception as e:
-    logger.error(f"Google Sheets 認証またはシートアクセスに失敗: {str(e)}")
-    exit(1)
-
-#Google Drive 認証#######################################################################################################
-gauth = GoogleAuth()
-gauth.credentials = creds
-drive = GoogleDrive(gauth)
-
-#スプレッドシート指定#######################################################################################################
-debt_spreadsheet = client.open("名簿DB")
-sheet1 = debt_spreadsheet.worksheet("名簿")
-reserve_spreadsheet = client.open("KeyNow")
-sheet2 = reserve_spreadsheet.worksheet("予約")
+        return ["指定条件の操作履歴はありません。"]
+    lines = [f"{datetime.fromtimestamp(ts).strftime('%Y/%m/%d %H:%M:%S')} - {key_name}: {user_name} が {action}"
+             for _, ts, action, key_name, user_name in rows]
+    messages, packed = pack_lines(lines, header="操作履歴(新しい順):", reserve=80)
+    if packed < len(rows) or len(rows) == HISTORY_PAGE_ROWS:
+        _, last_ts, *_ = rows[packed - 1]
+        messages[-1] += f"\n続きは「履歴確認 …(同じ条件) 続き:{last_ts}-{rows[packed - 1][0]}」"
+    return messages
+
+#ログ履歴の返信メッセージ
+async def history_reply_messages(args=()):
+    try:
+        filters = parse_history_args(args)
+    except ValueError as e:
+        return [f"{str(e)}\n例: 履歴確認 鍵:音倉 操作:借りる 期間:2025/04/01-2025/04/10"]
+    return await asyncio.to_thread(build_history_messages, filters)
+
+
+# Google Sheets / Drive(バックグラウンドで遅延・並列に接続)################################################################
+#起動時にはつながず、初回利用時か起動直後に別スレッドで認証とシートの取得を行う。失敗してもbot本体は止めずに再試行する
+SHEETS_SCOPE = [
+    "https://spreadsheets.google.com/feeds",
+    "https://www.googleapis.com/auth/drive"
+]
+SHEETS_TARGETS = {"roster": ("名簿DB", "名簿"), "reserve": ("KeyNow", "予約")}#用途 → (スプレッドシート, シート)
+SHEETS_RETRY_BASE = float(config.get("sheets_retry_base", 2.0))#秒。失敗するたびに倍
+SHEETS_RETRY_MAX = float(config.get("sheets_retry_max", 300.0))#秒
+
+class SheetsUnavailable(Exception):
+    pass
+
+class GoogleSheets:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.ready = threading.Event()
+        self.drive = None
+        self.spreadsheets = {}  # 用途 -> スプレッドシート
+        self.worksheets = {}  # 用途 -> シート
+        self.state = {"status": "idle", "attempts": 0, "failures": 0, "last_error": None,
+                      "ready_at": None, "next_retry_at": None}
+
+    #初期化スレッドを起動(2回目以降は何もしない)
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.state["status"] = "connecting"
+                self.thread = threading.Thread(target=self._connect_loop, name="keynow-sheets", daemon=True)
+                self.thread.start()
+
+    def _open(self, client, book, sheet):
+        spreadsheet = client.open(book)
+        worksheet = spreadsheet.worksheet(sheet)
+        logger.info("シート '%s' に正常にアクセスしました", sheet)
+        return spreadsheet, worksheet
+
+    def _connect(self):
+        with observe_time(sheets_request_seconds, "authorize", errors=sheets_errors):
+            creds = ServiceAccountCredentials.from_json_keyfile_name("GCOA.json", SHEETS_SCOPE)
+            client = gspread.authorize(creds)
+        logger.info("Google Sheets 認証成功")
+        gauth = GoogleAuth()
+        gauth.credentials = creds
+        drive = GoogleDrive(gauth)
+        # 各スプレッドシートは並列に開く
+        with ThreadPoolExecutor(max_workers=len(SHEETS_TARGETS), thread_name_prefix="keynow-sheets") as pool:
+            futures = {name: pool.submit(sheets_call, "open", self._open, client, book, sheet)
+                       for name, (book, sheet) in SHEETS_TARGETS.items()}
+            opened = {name: future.result() for name, future in futures.items()}
+        self.drive = drive
+        self.spreadsheets = {name: spreadsheet for name, (spreadsheet, _) in opened.items()}
+        self.worksheets = {name: worksheet for name, (_, worksheet) in opened.items()}
+
+    def _connect_loop(self):
+        delay = SHEETS_RETRY_BASE
+        while True:
+            self.state["attempts"] += 1
+            try:
+                self._connect()
+                break
+            except Exception as e:
+                wait = min(delay, SHEETS_RETRY_MAX) * random.uniform(0.5, 1.0)
+                delay *= 2
+                self.state.update(status="unavailable", last_error=str(e), next_retry_at=time.time() + wait)
+                self.state["failures"] += 1
+                logger.error("Google Sheets 認証またはシートアクセスに失敗(%.0f秒後に再試行): %s", wait, e)
+                time.sleep(wait)
+        self.state.update(status="ready", ready_at=time.time(), next_retry_at=None)
+        self.ready.set()
+        logger.info("Google Sheets / Drive 接続完了")
+        # 名簿ミラーと予約キャッシュを並列に読み込む
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="keynow-sheets") as pool:
+            pool.submit(refresh_roster, True)
+            pool.submit(refresh_reserve_schedule, True)
+
+    #接続済みのシート(未接続なら接続を始めて SheetsUnavailable)
+    def worksheet(self, name):
+        worksheet = self.worksheets.get(name)
+        if worksheet is None:
+            self.start()
+            raise SheetsUnavailable(f"Google Sheets に接続できていません({self.state['status']})")
+        return worksheet
+
+    def spreadsheet(self, name):
+        self.worksheet(name)
+        return self.spreadsheets[name]
+
+    #接続後の呼び出し結果で状態を更新する
+    def record(self, ok, error=None):
+        if not self.ready.is_set():
+            return
+        if ok:
+            if self.state["status"] != "ready":
+                self.state.update(status="ready", last_error=None)
+        else:
+            self.state.update(status="degraded", last_error=error)
+
+    def snapshot(self):
+        return {**self.state, "worksheets": sorted(self.worksheets)}
+
+google_sheets = GoogleSheets()
 
 # LINEAPI###############################################################################################################
-config = json.load(open("line.json", encoding="utf-8"))
-
 
 LINE_ACCESS_TOKEN = config["line_bot_token"]
-LINE_REPLY_URL = "https://api.line.me/v2/bot/message/reply"
-LINE_PUSH_URL = "https://api.line.me/v2/bot/message/push"
+LINE_API_BASE = config.get("line_api_base", "https://api.line.me")#負荷試験ではスタブサーバーを指定
+LINE_REPLY_URL = f"{LINE_API_BASE}/v2/bot/message/reply"
+LINE_PUSH_URL = f"{LINE_API_BASE}/v2/bot/message/push"
 AUTH_CODE = config["auth_code"]#認証グループコード
 
 #Flask / APScheduler 初期化##############################################################################################
 app = Flask(__name__)
 
+scheduler = None
+
+#ジョブは常駐イベントループ上で実行し、LINEクライアントを共有する
+#複数ワーカー運用でリーダーの期限が切れていたら実行しない(重複したリセット・通知を防ぐ)
+@timed_job
 def run_reset_key_holders():
-    asyncio.run(reset_key_holders())
+    if not is_scheduler_leader():
+        logger.warning("リーダーではないため 0時リセットを見送りました")
+        return
+    run_coroutine(reset_key_holders())
 
+@timed_job
 def run_notify_overdue_keys():
-    asyncio.run(notify_overdue_keys())
+    if not is_scheduler_leader():
+        logger.warning("リーダーではないため 未返却通知を見送りました")
+        return
+    run_coroutine(notify_overdue_keys())
+
+#返却期限ジョブ(deadline:<鍵名>)は実行する関数名で数える
+def on_job_missed(event):
+    job = "run_notify_overdue_keys" if event.job_id.startswith("deadline:") else event.job_id
+    job_misfires.inc(job)
+    logger.warning("スケジューラジョブの実行時刻を逃しました: %s (%s)", event.job_id, event.scheduled_run_time)
 
 def start_scheduler():  # APScheduler 起動用関数
+    global scheduler
     try:
-        scheduler = BackgroundScheduler()
-        scheduler.add_job(run_reset_key_holders, 'cron', hour=0, minute=0)#0:00reset
-        scheduler.add_job(run_notify_overdue_keys, 'interval', minutes=3)#sheet time reset
+        # 返却期限タイマーは再起動後も残るよう永続ジョブストアに置く
+        if SQLAlchemyJobStore is not None:
+            deadline_store = SQLAlchemyJobStore(url=f"sqlite:///{DB_PATH}")
+        else:
+            logger.warning("SQLAlchemy が無いため返却期限タイマーはメモリ上で管理します(起動時に再設定)")
+            deadline_store = MemoryJobStore()
+        scheduler = BackgroundScheduler(jobstores={"default": MemoryJobStore(), "deadlines": deadline_store})
+        scheduler.add_listener(on_job_missed, EVENT_JOB_MISSED)
+        scheduler.add_job(run_reset_key_holders, 'cron', hour=0, minute=0, id="run_reset_key_holders")#0:00reset
+        scheduler.add_job(purge_webhook_events, 'interval', hours=1, id="purge_webhook_events")#重複排除記録の期限切れ削除
+        scheduler.add_job(purge_line_outbox, 'interval', hours=1, id="purge_line_outbox")#送信済みの送信キュー削除
+        scheduler.add_job(run_history_rollup, 'interval', minutes=ROLLUP_INTERVAL_MINUTES,
+                          id="run_history_rollup")#履歴の日次集計
+        scheduler.add_job(run_history_retention, 'cron', hour=RETENTION_HOUR, minute=0,
+                          id="run_history_retention")#保持期間外の履歴削除・ANALYZE/VACUUM
+        scheduler.add_job(refresh_roster, 'interval', minutes=ROSTER_REFRESH_MINUTES, id="refresh_roster",
+                          next_run_time=datetime.now())#名簿ミラー更新
+        scheduler.add_job(refresh_reserve_schedule, 'interval', minutes=RESERVE_REFRESH_MINUTES, id="refresh_reserve_schedule",
+                          next_run_time=datetime.now())#予約シートキャッシュ更新
         scheduler.start()
+        reschedule_all_deadlines()
         logger.info("APScheduler 起動成功")
     except Exception as e:
-        logger.error(f"APScheduler 起動失敗: {str(e)}")
+        logger.error("APScheduler 起動失敗: %s", e)
 
 # SQLite 初期化##########################################################################################################
 DB_PATH = 'key_reservation.db'#鍵保管用DBの名前
-conn = None
+DB_CACHED_STATEMENTS = int(config.get("db_cached_statements", 256))#接続ごとのプリペアドステートメント数
+
+db_local = threading.local()
+db_stats = {"transactions": 0, "lock_wait_ms_total": 0.0, "lock_wait_ms_max": 0.0, "busy_errors": 0}#書き込みロック待ち
+db_connections = weakref.WeakSet()#閉じた接続は自然に外れる
+db_connections_lock = threading.Lock()
 
-#DB接続
+#文ごとの実行時間をメトリクスに記録するカーソル/接続(ラベルは先頭の語: SELECT, INSERT ...)
+def _sql_op(sql):
+    head = sql.split(None, 1)
+    return head[0].upper() if head else ""
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            db_query_seconds.observe(time.perf_counter() - started, _sql_op(sql))
+
+    def executemany(self, sql, params):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, params)
+        finally:
+            db_query_seconds.observe(time.perf_counter() - started, _sql_op(sql))
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, params):
+        return self.cursor().executemany(sql, params)
+
+class DBConnectionOwner:
+    pass
+
+#DB接続(スレッドごとに1本を使い回す。自動コミットで、まとめて書く時は db_transaction を使う)
 def get_db_connection():
+    conn = getattr(db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=10.0, isolation_level=None,
+                               cached_statements=DB_CACHED_STATEMENTS, factory=TimedConnection,
+                               check_same_thread=False)#使うのは作ったスレッドだけ。終了時の close のみ別スレッド
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=10000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-8000")
+        db_local.conn = conn
+        #スレッドが終わると threading.local の中身が捨てられ、その時点で接続を閉じる(開発サーバはリクエストごとにスレッドを作る)
+        db_local.owner = DBConnectionOwner()
+        weakref.finalize(db_local.owner, conn.close)
+        with db_connections_lock:
+            db_connections.add(conn)
+        logger.info("SQLite DB connection established (%s)", threading.current_thread().name)
+    return conn
+
+#明示的なトランザクション。ネストした場合は外側にまとめる
+#イベントループ上では中で await しないこと(同じ接続を他のコルーチンと共有しているため)
+@contextmanager
+def db_transaction():
+    conn = get_db_connection()
+    if conn.in_transaction:
+        yield conn
+        return
+    started = time.perf_counter()
     try:
-        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        conn.row_factory = sqlite3.Row
-        logger.info("SQLite DB connection established")
-        return conn
-    except Exception as e:
-        logger.error(f"データベース接続エラー: {str(e)}")
-        return None
+        conn.execute("BEGIN IMMEDIATE")
+    except sqlite3.OperationalError:
+        db_stats["busy_errors"] += 1
+        raise
+    locked = time.perf_counter()
+    wait_ms = (locked - started) * 1000
+    db_stats["transactions"] += 1
+    db_stats["lock_wait_ms_total"] += wait_ms
+    db_stats["lock_wait_ms_max"] = max(db_stats["lock_wait_ms_max"], wait_ms)
+    db_lock_wait_seconds.observe(locked - started)
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        db_transaction_seconds.observe(time.perf_counter() - locked)
+
+#1回のWebhookに含まれるイベントをまとめて処理する時の保留中の書き込み・返信・通知
+current_batch = contextvars.ContextVar("current_batch", default=None)
+
+class EventBatch:
+    def __init__(self, events, claims):
+        self.events = events
+        self.index = None  # 処理中のイベント(events の添字)
+        self.writes = []  # (イベント, sql, params, many)
+        self.claims = claims  # 受信記録 (webhookEventId, 受信時刻)
+        self.replies = {}  # reply_token -> [message]
+        self.reply_to = {}  # reply_token -> (pushに切り替える時の宛先, replyTokenの期限)
+        self.group_messages = []  # 認証済みグループへの通知 (message, priority, イベント)
+        self.users = {}  # このバッチで登録したユーザー line_id -> name
+        self.failed = {}  # 保留中の書き込みを確定できなかったイベント -> エラー
+
+#書き込み。バッチ処理中は保留してバッチ終了時に1トランザクションでまとめて書く
+def db_write(sql, params=(), many=False):
+    batch = current_batch.get()
+    if batch is not None:
+        batch.writes.append((batch.index, sql, params, many))
+        return
+    conn = get_db_connection()
+    if many:
+        conn.executemany(sql, params)
+    else:
+        conn.execute(sql, params)
+
+#終了時に全スレッドの接続を閉じる
+def close_db_connections():
+    with db_connections_lock:
+        for conn in list(db_connections):
+            try:
+                conn.close()
+            except Exception as e:
+                logger.error("データベース接続クローズ失敗: %s", e)
+        db_connections.clear()
+
+atexit.register(close_db_connections)
 
 #DB作成
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    with db_transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            line_id TEXT PRIMARY KEY,
+            student_no TEXT,
+            name TEXT
+        )""")
+        c.execute("CREATE TABLE IF NOT EXISTS groups ( group_id TEXT PRIMARY KEY )")
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS key_holders (
+            key_name TEXT PRIMARY KEY,
+            holder_id TEXT,
+            borrow_time TEXT
+        )""")
+        # 鍵操作履歴テーブル
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS key_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            action TEXT,
+            key_name TEXT,
+            user_name TEXT,
+            timestamp TEXT
+        )""")
+        # 名簿ミラー
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS roster (
+            student_no TEXT PRIMARY KEY,
+            name TEXT
+        )""")
+        # 受信済みWebhookイベント(再送の重複排除用)
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS webhook_events (
+            event_id TEXT PRIMARY KEY,
+            received_at REAL
+        )""")
+        # LINE表示名キャッシュ(永続層)
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS line_name_cache (
+            user_id TEXT PRIMARY KEY,
+            display_name TEXT,
+            expires_at REAL
+        )""")
+    logger.info("KeyLogのDBの初期化完了")
+
+init_db()
+
+# スキーマ移行(PRAGMA user_version で管理)##################################################################################
+#v1: key_logs にエポック秒(ts)と操作者ID(holder_id)を追加し、範囲検索用の索引を張る
+def migrate_key_logs_ts(c):
+    c.execute("ALTER TABLE key_logs ADD COLUMN ts INTEGER")
+    c.execute("ALTER TABLE key_logs ADD COLUMN holder_id TEXT")
+    # 既存の "%Y/%m/%d %H:%M:%S"(ローカル時刻)をエポック秒へ
+    c.execute("""
+    UPDATE key_logs
+    SET ts = CAST(strftime('%s', replace(timestamp, '/', '-'), 'utc') AS INTEGER)
+    """)
+    # 名前が一意に決まる場合のみ holder_id を補完
     c.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        line_id TEXT PRIMARY KEY,
-        student_no TEXT,
-        name TEXT
+    UPDATE key_logs
+    SET holder_id = (SELECT u.line_id FROM users u WHERE u.name = key_logs.user_name)
+    WHERE user_name IN (SELECT name FROM users GROUP BY name HAVING COUNT(*) = 1)
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_key_logs_action_key_user_ts ON key_logs(action, key_name, user_name, ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_key_logs_action_key_holder_ts ON key_logs(action, key_name, holder_id, ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_key_logs_ts ON key_logs(ts)")
+
+#v2: 日次集計(保持期間を過ぎて生ログを消しても統計を残す)と保守用の状態テーブル
+def migrate_retention_tables(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS key_log_daily (
+        day TEXT,
+        key_name TEXT,
+        action TEXT,
+        count INTEGER NOT NULL DEFAULT 0,
+        held_seconds INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, key_name, action)
     )""")
-    c.execute("CREATE TABLE IF NOT EXISTS groups ( group_id TEXT PRIMARY KEY )")
+    # 集計途中で貸出中の鍵(借りた・引き継いだ時刻)
+    c.execute("CREATE TABLE IF NOT EXISTS key_log_open_loans ( key_name TEXT PRIMARY KEY, since_ts INTEGER )")
+    c.execute("CREATE TABLE IF NOT EXISTS maintenance_state ( name TEXT PRIMARY KEY, value )")
+
+#v3: 鍵の登録(鍵・別名・まとめて扱う組)。既定は音倉・音練と「両方」
+def migrate_key_registry(c):
+    c.execute("CREATE TABLE IF NOT EXISTS key_registry ( key_name TEXT PRIMARY KEY, sort_order INTEGER NOT NULL DEFAULT 0 )")
+    c.execute("CREATE TABLE IF NOT EXISTS key_aliases ( alias TEXT PRIMARY KEY, key_name TEXT NOT NULL )")
+    c.execute("CREATE TABLE IF NOT EXISTS key_bundles ( bundle TEXT, key_name TEXT, PRIMARY KEY (bundle, key_name) )")
+    c.executemany("INSERT OR IGNORE INTO key_registry(key_name, sort_order) VALUES (?, ?)", [("音倉", 1), ("音練", 2)])
+    c.executemany("INSERT OR IGNORE INTO key_bundles(bundle, key_name) VALUES (?, ?)", [("両方", "音倉"), ("両方", "音練")])
+
+#v4: 複数ワーカー運用(リーダーの貸出期限とイベント受信箱)
+def migrate_multi_worker(c):
     c.execute("""
-    CREATE TABLE IF NOT EXISTS key_holders (
-        key_name TEXT PRIMARY KEY,
-        holder_id TEXT,
-        borrow_time TEXT
+    CREATE TABLE IF NOT EXISTS leader_lease (
+        name TEXT PRIMARY KEY,
+        holder TEXT,
+        expires_at REAL,
+        term INTEGER
     )""")
-    # 鍵操作履歴テーブル
     c.execute("""
-    CREATE TABLE IF NOT EXISTS key_logs (
+    CREATE TABLE IF NOT EXISTS event_inbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        events TEXT,
+        received_at REAL,
+        request_id TEXT
+    )""")
+
+#v5: 利用統計用の貸出区間(借りる/引き継ぎ〜返却/引き継ぎ)。生ログ削除後も残る
+def migrate_key_loans(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS key_loans (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
-        action TEXT,
         key_name TEXT,
+        holder_id TEXT,
         user_name TEXT,
-        timestamp TEXT
+        start_ts INTEGER,
+        end_ts INTEGER,
+        returned INTEGER,
+        overdue INTEGER
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_key_loans_start ON key_loans(start_ts)")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS key_loans_open (
+        key_name TEXT PRIMARY KEY,
+        holder_id TEXT,
+        user_name TEXT,
+        start_ts INTEGER,
+        overdue INTEGER
     )""")
-    conn.commit()
-    conn.close()
-    logger.info("KeyLogのDBの初期化完了")
 
-init_db()
+#v6: LINE送信キュー(reply/push/multicast を1行ずつ。送信済み・dead の行もしばらく残す)
+def migrate_line_outbox(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS line_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        idempotency_key TEXT UNIQUE,
+        kind TEXT,
+        target TEXT,
+        fallback_to TEXT,
+        messages TEXT,
+        retry_key TEXT,
+        created_at REAL,
+        expires_at REAL,
+        next_attempt_at REAL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'pending',
+        last_error TEXT,
+        sent_at REAL
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_line_outbox_due ON line_outbox(status, next_attempt_at)")
+
+MIGRATIONS = [
+    (1, migrate_key_logs_ts),
+    (2, migrate_retention_tables),
+    (3, migrate_key_registry),
+    (4, migrate_multi_worker),
+    (5, migrate_key_loans),
+    (6, migrate_line_outbox),
+]
+
+def run_migrations():
+    conn = get_db_connection()
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        #他のワーカーが先に移行しているかもしれないので、書き込みロックを取ってから読み直す
+        with db_transaction() as conn:
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version <= current:
+                continue
+            c = conn.cursor()
+            migrate(c)
+            c.execute(f"PRAGMA user_version = {version}")
+        logger.info("DBスキーマを v%s に移行しました (%s)", version, migrate.__name__)
+
+run_migrations()
+
+# 履歴の保持期間・日次集計・DBメンテナンス##################################################################################
+HISTORY_RETENTION_DAYS = int(config.get("history_retention_days", 30))#これより古い生ログは日次集計に残して削除
+RETENTION_BATCH_ROWS = int(config.get("retention_batch_rows", 500))#1トランザクションで処理する行数
+RETENTION_BATCH_PAUSE = float(config.get("retention_batch_pause", 0.05))#秒。バッチの間は書き込みロックを手放す
+ROLLUP_INTERVAL_MINUTES = int(config.get("rollup_interval_minutes", 60))#日次集計の更新間隔
+RETENTION_HOUR = int(config.get("retention_hour", 4))#生ログ削除とANALYZE/VACUUMを行う時刻
+VACUUM_INTERVAL_DAYS = float(config.get("vacuum_interval_days", 7))
+VACUUM_MIN_FREE_RATIO = float(config.get("vacuum_min_free_ratio", 0.2))#空きページがこの割合以上の時だけVACUUM
+LOAN_OPENING_ACTIONS = ("借りる", "引き継ぎ")
+LOAN_CLOSING_ACTIONS = ("返却", "引き継ぎ")#保有時間を締める操作(引き継ぎは前の保有者の分)
+
+retention_lock = threading.Lock()
+retention_stats = {"rolled_up": 0, "loans": 0, "trimmed": 0, "analyzed": 0, "vacuums": 0, "last_run": None}
+
+def get_maintenance_value(conn, name, default=0):
+    row = conn.execute("SELECT value FROM maintenance_state WHERE name=?", (name,)).fetchone()
+    return row[0] if row else default
+
+def set_maintenance_value(conn, name, value):
+    conn.execute("INSERT OR REPLACE INTO maintenance_state(name, value) VALUES (?, ?)", (name, value))
+
+#未集計の key_logs を id 順に少しずつ key_log_daily へ足し込む(戻り値: 集計した行数)
+#返却されずに次の借りるが来た貸出(0時リセット等)は保有時間に含めない
+def rollup_key_logs():
+    conn = get_db_connection()
+    total = 0
+    while True:
+        with db_transaction():
+            last_id = get_maintenance_value(conn, "rollup_last_id")
+            rows = conn.execute("SELECT id, action, key_name, ts FROM key_logs WHERE id > ? ORDER BY id LIMIT ?",
+                                (last_id, RETENTION_BATCH_ROWS)).fetchall()
+            if not rows:
+                break
+            open_loans = dict(conn.execute("SELECT key_name, since_ts FROM key_log_open_loans").fetchall())
+            daily = {}  # (日付, 鍵, 操作) -> [件数, 保有秒数]
+            for _, action, label, ts in rows:
+                if ts is None:
+                    continue
+                day = datetime.fromtimestamp(ts).strftime("%Y/%m/%d")
+                for key_name in label.split("・"):
+                    held = 0
+                    if action in LOAN_CLOSING_ACTIONS and key_name in open_loans:
+                        held = max(0, ts - open_loans.pop(key_name))
+                    if action in LOAN_OPENING_ACTIONS:
+                        open_loans[key_name] = ts
+                    entry = daily.setdefault((day, key_name, action), [0, 0])
+                    entry[0] += 1
+                    entry[1] += held
+            conn.executemany("""
+            INSERT INTO key_log_daily(day, key_name, action, count, held_seconds) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(day, key_name, action) DO UPDATE
+            SET count = count + excluded.count, held_seconds = held_seconds + excluded.held_seconds
+            """, [(day, key_name, action, count, held) for (day, key_name, action), (count, held) in daily.items()])
+            conn.execute("DELETE FROM key_log_open_loans")
+            conn.executemany("INSERT INTO key_log_open_loans(key_name, since_ts) VALUES (?, ?)", open_loans.items())
+            set_maintenance_value(conn, "rollup_last_id", rows[-1][0])
+        total += len(rows)
+        if len(rows) < RETENTION_BATCH_ROWS:
+            break
+        time.sleep(RETENTION_BATCH_PAUSE)
+    retention_stats["rolled_up"] += total
+    return total
+
+#返却されなかった貸出は0時リセットで終わったものとする
+def next_reset_ts(ts):
+    return int(datetime.combine(date.fromtimestamp(ts) + timedelta(days=1), dtime()).timestamp())
+
+#未処理の key_logs から貸出区間を作り key_loans に足す(戻り値: 処理した行数)
+#期限切れ通知が来た貸出は overdue=1、返却されずに次の借りるが来た貸出は returned=0
+def collect_key_loans():
+    conn = get_db_connection()
+    total = 0
+    while True:
+        with db_transaction():
+            last_id = get_maintenance_value(conn, "loans_last_id")
+            rows = conn.execute("""
+            SELECT id, action, key_name, user_name, holder_id, ts FROM key_logs WHERE id > ? ORDER BY id LIMIT ?
+            """, (last_id, RETENTION_BATCH_ROWS)).fetchall()
+            if not rows:
+                break
+            open_loans = {key_name: list(loan) for key_name, *loan in
+                          conn.execute("SELECT key_name, holder_id, user_name, start_ts, overdue FROM key_loans_open")}
+            closed = []
+            for _, action, label, user_name, holder_id, ts in rows:
+                if ts is None:
+                    continue
+                for key_name in label.split("・"):
+                    loan = open_loans.get(key_name)
+                    if action == "通知":
+                        if loan is not None:
+                            loan[3] = 1
+                        continue
+                    if action in LOAN_CLOSING_ACTIONS and loan is not None:
+                        closed.append((key_name, *loan[:3], ts, 1, loan[3]))
+                        del open_loans[key_name]
+                    elif action in LOAN_OPENING_ACTIONS and loan is not None:
+                        closed.append((key_name, *loan[:3], min(ts, next_reset_ts(loan[2])), 0, loan[3]))
+                    if action in LOAN_OPENING_ACTIONS:
+                        open_loans[key_name] = [holder_id, user_name, ts, 0]
+            conn.executemany("""
+            INSERT INTO key_loans(key_name, holder_id, user_name, start_ts, end_ts, returned, overdue)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, closed)
+            conn.execute("DELETE FROM key_loans_open")
+            conn.executemany("INSERT INTO key_loans_open(key_name, holder_id, user_name, start_ts, overdue) VALUES (?, ?, ?, ?, ?)",
+                             [(key_name, *loan) for key_name, loan in open_loans.items()])
+            set_maintenance_value(conn, "loans_last_id", rows[-1][0])
+        total += len(rows)
+        if len(rows) < RETENTION_BATCH_ROWS:
+            break
+        time.sleep(RETENTION_BATCH_PAUSE)
+    retention_stats["loans"] += total
+    return total
+
+#保持期間を過ぎた生ログを少しずつ削除(集計済みの行だけ。戻り値: 削除した行数)
+def trim_key_logs(days=None):
+    cutoff = int((datetime.now() - timedelta(days=days or HISTORY_RETENTION_DAYS)).timestamp())
+    conn = get_db_connection()
+    total = 0
+    while True:
+        with db_transaction():
+            rolled_up_id = min(get_maintenance_value(conn, "rollup_last_id"),
+                               get_maintenance_value(conn, "loans_last_id"))
+            deleted = conn.execute("""
+            DELETE FROM key_logs WHERE id IN (
+                SELECT id FROM key_logs WHERE ts < ? AND id <= ? LIMIT ?
+            )""", (cutoff, rolled_up_id, RETENTION_BATCH_ROWS)).rowcount
+        total += deleted
+        if deleted < RETENTION_BATCH_ROWS:
+            break
+        time.sleep(RETENTION_BATCH_PAUSE)
+    retention_stats["trimmed"] += total
+    return total
+
+#統計情報の更新と、空きが多い時だけVACUUM(間隔は VACUUM_INTERVAL_DAYS 以上あける)
+def maintain_db():
+    conn = get_db_connection()
+    conn.execute("PRAGMA analysis_limit=1000")
+    conn.execute("ANALYZE")
+    retention_stats["analyzed"] += 1
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    last_vacuum = get_maintenance_value(conn, "last_vacuum_at")
+    if not page_count or free_pages / page_count < VACUUM_MIN_FREE_RATIO:
+        return
+    if time.time() - last_vacuum < VACUUM_INTERVAL_DAYS * 86400:
+        return
+    started = time.perf_counter()
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    set_maintenance_value(conn, "last_vacuum_at", int(time.time()))
+    retention_stats["vacuums"] += 1
+    logger.info("VACUUM完了: 空き %s/%s ページ (%.0fms)", free_pages, page_count,
+                (time.perf_counter() - started) * 1000)
+
+#日次集計の更新(スケジューラから)
+@timed_job
+def run_history_rollup():
+    with retention_lock:
+        try:
+            rolled = rollup_key_logs()
+            collect_key_loans()
+            if rolled:
+                logger.info("履歴の日次集計: %s 件", rolled)
+        except Exception as e:
+            logger.error("履歴の日次集計に失敗: %s", e)
+
+#集計→保持期間外の削除→ANALYZE/VACUUM(スケジューラ、履歴削除コマンドから。戻り値: 削除した行数)
+@timed_job
+def run_history_retention(maintain=True):
+    with retention_lock:
+        rolled = rollup_key_logs()
+        collect_key_loans()
+        trimmed = trim_key_logs()
+        if maintain:
+            maintain_db()
+        retention_stats["last_run"] = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+        logger.info("履歴の保持処理: 集計 %s 件 / %s日より前を削除 %s 件", rolled, HISTORY_RETENTION_DAYS, trimmed)
+        return trimmed
+
+# 利用統計(貸出区間から利用率・時間帯別の使用率・平均貸出時間・期限超過率・よく借りる人)#####################################
+#key_loans は1回だけ全件読み、以降は増えた行だけ読み足す。結果は集計期間ごとに USAGE_STATS_TTL 秒使い回す
+USAGE_STATS_DAYS = int(config.get("usage_stats_days", 30))#「利用統計」の既定の集計期間
+USAGE_STATS_MAX_DAYS = 3660
+USAGE_STATS_TTL = float(config.get("usage_stats_ttl", 60))#秒。貸出中の分を含むので長くは持たない
+USAGE_TOP_HOLDERS = 5
+HEAT_BARS = "▁▂▃▄▅▆▇█"
+
+class UsageStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_id = 0
+        self.keys = {}  # 鍵名 -> 番号
+        self.holders = {}  # holder_id -> 番号
+        self.names = []  # holder番号 -> 最新の名前
+        self.columns = {"start": [], "end": [], "key": [], "holder": [], "returned": [], "overdue": []}
+        self.arrays = None  # numpy 使用時の columns の配列版(読み足したら作り直す)
+        self.cache = {}  # 日数 -> (計算時刻, last_id, 結果)
+        self.stats = {"loans": 0, "loads": 0, "hits": 0, "computes": 0, "last_ms": None}
+
+    def _append(self, columns, key_name, holder_id, user_name, start, end, returned, overdue):
+        if holder_id not in self.holders:
+            self.holders[holder_id] = len(self.names)
+            self.names.append(user_name)
+        holder = self.holders[holder_id]
+        self.names[holder] = user_name
+        columns["start"].append(start)
+        columns["end"].append(end)
+        columns["key"].append(self.keys.setdefault(key_name, len(self.keys)))
+        columns["holder"].append(holder)
+        columns["returned"].append(returned)
+        columns["overdue"].append(overdue)
+
+    #前回以降に増えた貸出区間だけ読み足す
+    def _load(self, conn):
+        rows = conn.execute("""
+        SELECT id, key_name, holder_id, user_name, start_ts, end_ts, returned, overdue FROM key_loans WHERE id > ? ORDER BY id
+        """, (self.last_id,)).fetchall()
+        for _, *loan in rows:
+            self._append(self.columns, *loan)
+        if rows:
+            self.last_id = rows[-1][0]
+            self.arrays = None
+            self.stats["loads"] += 1
+            self.stats["loans"] = len(self.columns["start"])
+
+    #確定した貸出 + 貸出中(0時リセットまでで打ち切り)の列
+    def _columns(self, conn, now):
+        extra = {name: [] for name in self.columns}
+        for key_name, holder_id, user_name, start, overdue in conn.execute(
+                "SELECT key_name, holder_id, user_name, start_ts, overdue FROM key_loans_open"):
+            self._append(extra, key_name, holder_id, user_name, start, min(now, next_reset_ts(start)), 0, overdue)
+        if np is None:
+            return {name: values + extra[name] for name, values in self.columns.items()}
+        if self.arrays is None:
+            self.arrays = {name: np.asarray(values, dtype=np.int64) for name, values in self.columns.items()}
+        return {name: np.concatenate([values, np.asarray(extra[name], dtype=np.int64)])
+                for name, values in self.arrays.items()}
+
+    #[since, now) に重なる分を鍵ごと・人ごとに足し合わせる。heat は鍵×時刻(0〜23時)の使用秒数
+    def _aggregate_numpy(self, c, since, now, offset):
+        n_keys, n_holders = len(self.keys), len(self.names)
+        s = np.clip(c["start"], since, now)
+        e = np.clip(c["end"], since, now)
+        held = e - s
+        started = (c["start"] >= since) & (c["start"] < now)
+        done = started & (c["returned"] == 1)
+        hours = np.arange(24) * 3600
+
+        def occupied(t):  # 基準日0時から t までに各時刻帯を占めた秒数
+            local = (t + offset)[:, None]
+            return (local // 86400) * 3600 + np.clip(local % 86400 - hours, 0, 3600)
+
+        heat = np.zeros((n_keys, 24))
+        np.add.at(heat, c["key"], occupied(e) - occupied(s))
+        count = lambda index, weights, size: np.bincount(index, weights=weights, minlength=size).tolist()
+        return {
+            "held": count(c["key"], held, n_keys),
+            "loans": count(c["key"], started, n_keys),
+            "overdue": count(c["key"], started & (c["overdue"] == 1), n_keys),
+            "duration": count(c["key"], np.where(done, c["end"] - c["start"], 0), n_keys),
+            "returned": count(c["key"], done, n_keys),
+            "heat": heat.tolist(),
+            "holder_loans": count(c["holder"], started, n_holders),
+            "holder_held": count(c["holder"], held, n_holders),
+        }
+
+    def _aggregate_python(self, c, since, now, offset):
+        n_keys, n_holders = len(self.keys), len(self.names)
+        result = {name: [0] * n_keys for name in ("held", "loans", "overdue", "duration", "returned")}
+        result["heat"] = [[0] * 24 for _ in range(n_keys)]
+        result["holder_loans"] = [0] * n_holders
+        result["holder_held"] = [0] * n_holders
+
+        def occupied(t, hour):
+            local = t + offset
+            return (local // 86400) * 3600 + min(max(local % 86400 - hour * 3600, 0), 3600)
+
+        for start, end, key, holder, returned, overdue in zip(*(c[name] for name in self.columns)):
+            s, e = min(max(start, since), now), min(max(end, since), now)
+            if e > s:
+                result["held"][key] += e - s
+                result["holder_held"][holder] += e - s
+                heat = result["heat"][key]
+                for hour in range(24):
+                    heat[hour] += occupied(e, hour) - occupied(s, hour)
+            if since <= start < now:
+                result["loans"][key] += 1
+                result["holder_loans"][holder] += 1
+                result["overdue"][key] += overdue
+                if returned:
+                    result["duration"][key] += end - start
+                    result["returned"][key] += 1
+        return result
+
+    def summary(self, days):
+        now = int(time.time())
+        with self.lock:
+            started = time.perf_counter()
+            conn = get_db_connection()
+            self._load(conn)#確定した貸出が増えていればキャッシュは使わない
+            cached = self.cache.get(days)
+            if cached and now - cached[0] < USAGE_STATS_TTL and cached[1] == self.last_id:
+                self.stats["hits"] += 1
+                return cached[2]
+            columns = self._columns(conn, now)
+            offset = int(datetime.fromtimestamp(now).astimezone().utcoffset().total_seconds())
+            aggregate = self._aggregate_python if np is None else self._aggregate_numpy
+            result = aggregate(columns, now - days * 86400, now, offset)
+            result["keys"] = list(self.keys)
+            result["names"] = list(self.names)
+            self.cache[days] = (now, self.last_id, result)
+            self.stats["computes"] += 1
+            self.stats["last_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            return result
+
+    def snapshot(self):
+        return {"numpy": np is not None, "last_id": self.last_id, **self.stats}
+
+usage_stats = UsageStats()
+
+def format_duration(seconds):
+    minutes = int(seconds // 60)
+    return f"{minutes // 60}時間{minutes % 60:02d}分" if minutes >= 60 else f"{minutes}分"
+
+#「利用統計 [日数]」の返信文
+def usage_stats_reply(result, days):
+    until = datetime.now()
+    lines = [f"利用統計(過去{days}日 {(until - timedelta(days=days)).strftime('%Y/%m/%d')}〜{until.strftime('%Y/%m/%d')})"]
+    indexes = sorted(range(len(result["keys"])), key=lambda i: key_registry.order.get(result["keys"][i], len(key_registry.order)))
+    for i in indexes:
+        if not result["held"][i] and not result["loans"][i]:
+            continue
+        loans = result["loans"][i]
+        lines.append(f"■{result['keys'][i]} 貸出{int(loans)}回 利用率{result['held'][i] / (days * 86400):.1%}")
+        if result["returned"][i]:
+            lines.append(f" 平均貸出時間 {format_duration(result['duration'][i] / result['returned'][i])}")
+        if loans:
+            lines.append(f" 期限超過 {result['overdue'][i] / loans:.1%}({int(result['overdue'][i])}回)")
+        heat = [seconds / (days * 3600) for seconds in result["heat"][i]]
+        peak = max(range(24), key=heat.__getitem__)
+        top = max(heat) or 1
+        bars = "".join(HEAT_BARS[min(len(HEAT_BARS) - 1, int(rate / top * len(HEAT_BARS)))] for rate in heat)
+        lines.append(f" 時間帯 0時{bars}23時")
+        lines.append(f" 最も使われる時間 {peak}時台({heat[peak]:.0%})")
+    if len(lines) == 1:
+        lines.append("この期間の貸出記録はありません。")
+        return "\n".join(lines)
+    holders = sorted((i for i, loans in enumerate(result["holder_loans"]) if loans),
+                     key=lambda i: (-result["holder_loans"][i], -result["holder_held"][i]))[:USAGE_TOP_HOLDERS]
+    if holders:
+        lines.append("■よく借りる人")
+        lines.extend(f" {rank}. {result['names'][i]} {int(result['holder_loans'][i])}回(計{format_duration(result['holder_held'][i])})"
+                     for rank, i in enumerate(holders, 1))
+    return "\n".join(lines)
+
+# 鍵の登録(鍵・別名・組)##################################################################################################
+#line.json に "keys" があればそちらを使い、無ければDB(key_registry, key_aliases, key_bundles)から読む
+#  "keys": ["音倉", "音練"], "key_aliases": {"倉": "音倉"}, "key_bundles": {"両方": ["音倉", "音練"]}
+KEY_SEPARATORS = ("・", ",", "、", "，")#「借りる 音倉・音練」のように1語で複数指定する時の区切り
+
+class KeyRegistry:
+    def __init__(self):
+        self.keys = []  # 表示順
+        self.order = {}  # 鍵 -> 表示順
+        self.names = {}  # 鍵名・別名・組名 -> 鍵のタプル
+        self.bundles = {}
+        self.source = None
+
+    def load(self):
+        if config.get("keys"):
+            keys = list(config["keys"])
+            aliases = dict(config.get("key_aliases", {}))
+            bundles = {name: list(members) for name, members in config.get("key_bundles", {}).items()}
+            self.source = "line.json"
+        else:
+            conn = get_db_connection()
+            keys = [row[0] for row in conn.execute("SELECT key_name FROM key_registry ORDER BY sort_order, key_name")]
+            aliases = dict(conn.execute("SELECT alias, key_name FROM key_aliases").fetchall())
+            bundles = {}
+            for bundle, key_name in conn.execute("SELECT bundle, key_name FROM key_bundles"):
+                bundles.setdefault(bundle, []).append(key_name)
+            self.source = "db"
+
+        for key_name in [k for k in keys if any(sep in k for sep in KEY_SEPARATORS)]:
+            logger.error("鍵名に区切り文字は使えません: %s", key_name)
+            keys.remove(key_name)
+        order = {k: i for i, k in enumerate(keys)}
+        names = {k: (k,) for k in keys}
+        for alias, key_name in aliases.items():
+            if key_name in order:
+                names.setdefault(alias, (key_name,))
+            else:
+                logger.error("別名 %s の鍵 %s は登録されていません", alias, key_name)
+        valid_bundles = {}
+        for bundle, members in bundles.items():
+            unknown = [k for k in members if k not in order]
+            if unknown or not members:
+                logger.error("組 %s に登録されていない鍵があります: %s", bundle, unknown)
+                continue
+            valid_bundles[bundle] = tuple(sorted(set(members), key=order.get))
+            names.setdefault(bundle, valid_bundles[bundle])
+        self.keys, self.order, self.names, self.bundles = keys, order, names, valid_bundles
+        logger.info("鍵の登録を読み込みました(%s): 鍵 %s / 別名 %s / 組 %s", self.source, keys, len(aliases), list(valid_bundles))
+
+    #引数(スペース・区切り文字で複数可)を鍵の集合に解決する(戻り値: 表示順の鍵リスト, 不明な語のリスト)
+    def resolve(self, tokens):
+        selected = set()
+        unknown = []
+        for token in tokens:
+            for sep in KEY_SEPARATORS[1:]:
+                token = token.replace(sep, KEY_SEPARATORS[0])
+            for name in filter(None, token.split(KEY_SEPARATORS[0])):
+                keys = self.names.get(name)
+                if keys is None:
+                    unknown.append(name)
+                else:
+                    selected.update(keys)
+        return sorted(selected, key=self.order.get), unknown
+
+    #使える指定の一覧(案内文用)
+    def describe(self):
+        return "".join(f"「{name}」" for name in self.keys + list(self.bundles))
+
+    def snapshot(self):
+        return {"source": self.source, "keys": self.keys, "bundles": {b: list(k) for b, k in self.bundles.items()},
+                "aliases": {n: k[0] for n, k in self.names.items() if n not in self.order and n not in self.bundles}}
+
+key_registry = KeyRegistry()
+key_registry.load()
+
+# 鍵状態エンジン(メモリ上の鍵→保有者 + key_holdersへの書き込み)##########################################################
+class KeyStateEngine:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.holders = {}  # key_name -> (holder_id, borrow_time)
+
+    def load(self):
+        rows = get_db_connection().execute("SELECT key_name, holder_id, borrow_time FROM key_holders").fetchall()
+        with self.lock:
+            self.holders = {key_name: (holder_id, borrow_time) for key_name, holder_id, borrow_time in rows}
+        logger.info("鍵状態を読み込みました: %s 件", len(rows))
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.holders)
+
+    def holders_of(self, keys):
+        with self.lock:
+            return {k: self.holders.get(k, (None, None))[0] for k in keys}
+
+    #keys の保有者が expected と一致する時だけ new_holder に書き換える(Noneは返却)
+    #ロックを持ったまま1トランザクションで key_holders と操作記録(log: key_log_params の引数)を書く
+    #(バッチの確定を待たないので、並行するバッチの間でも書き込みと key_logs の id は操作した順になる)
+    #DBへの書き込みが失敗した場合はメモリも変更しない
+    #返却期限タイマーもロックの中で付け替える(外でやると後から来た別の人の貸出のタイマーを消してしまう)
+    def compare_and_set(self, keys, expected, new_holder, borrow_time=None, log=None):
+        with self.lock:
+            current = {k: self.holders.get(k, (None, None))[0] for k in keys}
+            if current != expected:
+                return False, current
+            with db_transaction() as conn:
+                if new_holder is None:
+                    conn.executemany("DELETE FROM key_holders WHERE key_name=?", [(k,) for k in keys])
+                else:
+                    conn.executemany("INSERT OR REPLACE INTO key_holders(key_name, holder_id, borrow_time) VALUES (?, ?, ?)",
+                                     [(k, new_holder, borrow_time) for k in keys])
+                if log:
+                    conn.execute(KEY_LOG_SQL, key_log_params(*log))
+            for k in keys:
+                if new_holder is None:
+                    self.holders.pop(k, None)
+                    cancel_key_deadline(k)
+                else:
+                    self.holders[k] = (new_holder, borrow_time)
+                    schedule_key_deadline(k, borrow_time)
+            return True, current
+
+    def borrow(self, keys, holder_id, borrow_time, log=None):
+        return self.compare_and_set(keys, {k: None for k in keys}, holder_id, borrow_time, log)
+
+    def release(self, keys, holder_id, log=None):
+        return self.compare_and_set(keys, {k: holder_id for k in keys}, None, log=log)
+
+    #全ての鍵が同じ人に借りられている時だけ引き継げる
+    def handover(self, keys, holder_id, borrow_time, log=None):
+        current = self.holders_of(keys)
+        previous = set(current.values())
+        if None in previous or len(previous) != 1:
+            return False, current
+        return self.compare_and_set(keys, current, holder_id, borrow_time, log)
+
+    #リセットも compare_and_set と同じくロックを持ったまま確定させる(同じバッチ内の前後の操作と順序が入れ替わらない)
+    def clear(self):
+        with self.lock:
+            with db_transaction() as conn:
+                conn.execute("DELETE FROM key_holders")
+            self.holders.clear()
+            cancel_all_deadlines()
+
+key_state = KeyStateEngine()
+key_state.load()
+
+# 名簿ミラー(学籍番号 → 名前)##############################################################################################
+ROSTER_REFRESH_MINUTES = int(config.get("roster_refresh_minutes", 10))#定期再読込間隔
+ROSTER_MAX_AGE = float(config.get("roster_max_age", 1800))#秒。これより古ければ参照前に再読込
+
+roster_index = {}
+roster_lock = threading.Lock()
+roster_refresh_lock = threading.Lock()
+roster_state = {"loaded_at": 0.0, "modified": None, "refreshes": 0, "unchanged": 0, "hits": 0, "misses": 0}
+
+#前回起動時のミラーをDBから復元
+def load_roster_from_db():
+    conn = get_db_connection()
+    rows = conn.execute("SELECT student_no, name FROM roster").fetchall()
+    with roster_lock:
+        roster_index.update(rows)
+    logger.info("名簿ミラー復元: %s 件", len(rows))
+
+#Sheets/Drive 呼び出し(時間と失敗をメトリクスに記録)
+def sheets_call(call, func, *args, **kwargs):
+    try:
+        with observe_time(sheets_request_seconds, call, errors=sheets_errors):
+            result = func(*args, **kwargs)
+    except Exception as e:
+        google_sheets.record(False, str(e))
+        raise
+    google_sheets.record(True)
+    return result
+
+#Drive上の更新日時(取得失敗時None)
+def get_spreadsheet_modified(spreadsheet):
+    try:
+        meta = google_sheets.drive.CreateFile({"id": spreadsheet.id})
+        sheets_call("drive_metadata", meta.FetchMetadata, fields="modifiedDate")
+        return meta["modifiedDate"]
+    except Exception as e:
+        logger.warning("スプレッドシート更新日時の取得に失敗: %s", e)
+        return None
+
+#名簿シートを一括取得して差分だけ反映する
+def refresh_roster(force=False):
+    if not roster_refresh_lock.acquire(blocking=False):
+        return  # 他スレッドで再読込中
+    try:
+        roster_sheet = google_sheets.worksheet("roster")
+        modified = get_spreadsheet_modified(google_sheets.spreadsheet("roster"))
+        if not force and modified and modified == roster_state["modified"]:
+            roster_state["loaded_at"] = time.time()
+            roster_state["unchanged"] += 1
+            return
+
+        # シートを直接検索する時(findall)と同じく、どの列でも値が一致した最初のセル(行→列の順)の右隣を名前とする
+        fresh = {}
+        for row in sheets_call("get_all_values", roster_sheet.get_all_values):
+            for col, value in enumerate(row):
+                if value:
+                    fresh.setdefault(value, row[col + 1] if col + 1 < len(row) else "")
+
+        with roster_lock:
+            changed = {no: name for no, name in fresh.items() if roster_index.get(no) != name}
+            removed = [no for no in roster_index if no not in fresh]
+            roster_index.update(changed)
+            for no in removed:
+                del roster_index[no]
+
+        if changed or removed:
+            with db_transaction() as conn:
+                conn.executemany("INSERT OR REPLACE INTO roster(student_no, name) VALUES (?, ?)", changed.items())
+                conn.executemany("DELETE FROM roster WHERE student_no=?", [(no,) for no in removed])
+
+        roster_state.update(loaded_at=time.time(), modified=modified)
+        roster_state["refreshes"] += 1
+        logger.info("名簿ミラー更新: 全%s件 (変更 %s / 削除 %s)", len(fresh), len(changed), len(removed))
+    except SheetsUnavailable as e:
+        logger.info("名簿ミラー更新を見送りました: %s", e)
+    except Exception as e:
+        logger.error("名簿ミラー更新失敗: %s", e)
+    finally:
+        roster_refresh_lock.release()
+
+#学籍番号から名前を取得(見つからなければNone)。ミラーに無い時だけシートを直接検索
+def lookup_student_name(student_no):
+    if time.time() - roster_state["loaded_at"] > ROSTER_MAX_AGE:
+        refresh_roster()
+    with roster_lock:
+        name = roster_index.get(student_no)
+    if name is not None:
+        roster_state["hits"] += 1
+        return name
+
+    roster_state["misses"] += 1
+    roster_sheet = google_sheets.worksheet("roster")  # 未接続なら SheetsUnavailable
+    found_cells = sheets_call("findall", roster_sheet.findall, student_no)
+    if not found_cells:
+        return None
+    # 最初に見つかったセルの右隣を名前として取得
+    cell = found_cells[0]
+    name = sheets_call("cell", roster_sheet.cell, cell.row, cell.col + 1).value
+    with roster_lock:
+        roster_index[student_no] = name
+    get_db_connection().execute("INSERT OR REPLACE INTO roster(student_no, name) VALUES (?, ?)", (student_no, name))
+    return name
+
+load_roster_from_db()
+
+# 予約カレンダー(鍵ごとの使用可能時間帯)####################################################################################
+#予約シートの <日付:20xx/mm/dd><時間:14-18>(続けて鍵名を書けばその鍵だけ、無ければ全ての鍵)を時間帯の索引にする
+#指定のある日は時間帯の中でだけ借りられ、時間帯の終わりが返却期限。指定の無い日は0時から DEFAULT_END_TIME まで
+DEFAULT_END_TIME = "20:55"#予約指定が無い日の返却期限(21時以降までの指定もここで打ち切る)
+RESERVE_REFRESH_MINUTES = int(config.get("reserve_refresh_minutes", 5))
+RESERVE_LOOKAHEAD_DAYS = int(config.get("reserve_lookahead_days", 14))#次に借りられる時間帯を探す日数
+ALL_KEYS = ""#鍵の指定が無い行
+
+reserve_refresh_lock = threading.Lock()
+reserve_state = {"loaded_at": 0.0, "modified": None, "refreshes": 0, "unchanged": 0, "changed_days": 0}
+
+#"14" / "14:30" → 0時からの分
+def parse_clock(text):
+    hour, _, minute = text.strip().partition(":")
+    hour, minute = int(hour), int(minute or 0)
+    if not (0 <= hour <= 24 and 0 <= minute < 60):
+        raise ValueError(text)
+    return hour * 60 + minute
+
+#日付 → {鍵(指定なしは ALL_KEYS): [(開始分, 終了分)]}
+def parse_reserve_rows(rows):
+    limit = parse_clock(DEFAULT_END_TIME)
+    days = {}
+    for row in rows:
+        for col, value in enumerate(row[:-1]):
+            try:
+                day = datetime.strptime(value.strip(), "%Y/%m/%d").strftime("%Y/%m/%d")
+                start, end = map(parse_clock, row[col + 1].split("-"))
+            except ValueError:
+                continue
+            end = min(end, limit)
+            if start >= end:
+                continue
+            keys, unknown = key_registry.resolve(row[col + 2:col + 3])
+            for key_name in (keys if keys and not unknown else [ALL_KEYS]):
+                days.setdefault(day, {}).setdefault(key_name, []).append((start, end))
+    return days
+
+def day_start_ts(day):
+    return int(datetime.strptime(day, "%Y/%m/%d").timestamp())
+
+class ReserveCalendar:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.days = {}  # parse_reserve_rows の結果
+        # 鍵 → (開始時刻のリスト, 終了時刻のリスト)。エポック秒で時刻順、重なりは結合済み(全ての鍵向けの指定を含む)
+        self.index = {key_name: ([], []) for key_name in key_registry.keys + [ALL_KEYS]}
+
+    #その日の鍵の時間帯(全ての鍵向けの指定を足して重なりを結合)
+    def _day_windows(self, day, key_name):
+        entries = self.days.get(day, {})
+        windows = sorted(entries.get(key_name, []) + (entries.get(ALL_KEYS, []) if key_name != ALL_KEYS else []))
+        base = day_start_ts(day)
+        merged = []
+        for start, end in windows:
+            if merged and base + start * 60 <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], base + end * 60)
+            else:
+                merged.append([base + start * 60, base + end * 60])
+        return merged
+
+    #内容が変わった日だけ索引を差し替える(戻り値: 変わった日付の集合)
+    def update(self, days):
+        changed = {day for day in days.keys() | self.days.keys() if days.get(day) != self.days.get(day)}
+        with self.lock:
+            self.days = days
+            for key_name, (starts, ends) in self.index.items():
+                for day in changed:
+                    base = day_start_ts(day)
+                    lo, hi = bisect_left(starts, base), bisect_left(starts, base + 86400)
+                    windows = self._day_windows(day, key_name)
+                    starts[lo:hi] = [start for start, _ in windows]
+                    ends[lo:hi] = [end for _, end in windows]
+        return changed
+
+    def _windows(self, key_name):
+        return self.index.get(key_name) or self.index[ALL_KEYS]
+
+    #その日にこの鍵の時間指定があるか
+    def is_reserved_day(self, key_name, day):
+        entries = self.days.get(day.strftime("%Y/%m/%d"))
+        return bool(entries) and (key_name in entries or ALL_KEYS in entries)
+
+    #when 以降に終わる最初の時間帯(その日のうち)
+    def _next_on_day(self, key_name, day, when):
+        base = int(datetime.combine(day, dtime()).timestamp())
+        with self.lock:
+            starts, ends = self._windows(key_name)
+            i = bisect_right(ends, max(when.timestamp(), base))
+            if i < len(ends) and starts[i] < base + 86400:
+                return datetime.fromtimestamp(starts[i]), datetime.fromtimestamp(ends[i])
+        return None
+
+    #時間指定のある日に時間帯の外(借りられない)か
+    def is_closed(self, key_name, when):
+        if not self.is_reserved_day(key_name, when.date()):
+            return False
+        window = self._next_on_day(key_name, when.date(), when)
+        return window is None or when < window[0]
+
+    #when に借りた(引き継いだ)鍵の返却期限。時間帯の前なら次の時間帯の終わり
+    #その日の時間帯が全て終わった後(時間外の引き継ぎなど)は次に借りられる時間帯の終わり、それも無ければ0時リセット
+    def deadline(self, key_name, when):
+        if not self.is_reserved_day(key_name, when.date()):
+            end = datetime.combine(when.date(), dtime(*map(int, DEFAULT_END_TIME.split(":"))))
+            if when < end:
+                return end
+        else:
+            window = self._next_on_day(key_name, when.date(), when)
+            if window:
+                return window[1]
+        window = self.next_window(key_name, when)
+        return window[1] if window else datetime.fromtimestamp(next_reset_ts(when.timestamp()))
+
+    #when 以降で次に借りられる時間帯(開始, 終了)。RESERVE_LOOKAHEAD_DAYS 日先まで探す
+    def next_window(self, key_name, when):
+        for offset in range(RESERVE_LOOKAHEAD_DAYS + 1):
+            day = when.date() + timedelta(days=offset)
+            if self.is_reserved_day(key_name, day):
+                window = self._next_on_day(key_name, day, when)
+            else:
+                window = (datetime.combine(day, dtime()), self.deadline(key_name, datetime.combine(day, dtime())))
+            if window and when < window[1]:
+                return max(when, window[0]), window[1]
+        return None
+
+    def snapshot(self):
+        return {"days": len(self.days), "windows": {key_name or "*": len(starts) for key_name, (starts, _) in self.index.items()}}
+
+reserve_calendar = ReserveCalendar()
+
+#予約シートが更新されていれば一括取得し、変わった日だけ索引を作り直す
+def refresh_reserve_schedule(force=False):
+    if not reserve_refresh_lock.acquire(blocking=False):
+        return
+    try:
+        reserve_sheet = google_sheets.worksheet("reserve")
+        modified = get_spreadsheet_modified(google_sheets.spreadsheet("reserve"))
+        if not force and modified and modified == reserve_state["modified"]:
+            reserve_state["loaded_at"] = time.time()
+            reserve_state["unchanged"] += 1
+            return
+        changed = reserve_calendar.update(parse_reserve_rows(sheets_call("get_all_values", reserve_sheet.get_all_values)))
+        reserve_state.update(loaded_at=time.time(), modified=modified)
+        reserve_state["refreshes"] += 1
+        reserve_state["changed_days"] += len(changed)
+        logger.info("予約カレンダー更新: %s 日分(変更 %s 日)", len(reserve_calendar.days), len(changed))
+        if date.today().strftime("%Y/%m/%d") in changed:
+            reschedule_all_deadlines()
+    except SheetsUnavailable as e:
+        logger.info("予約カレンダー更新を見送りました: %s", e)
+    except Exception as e:
+        logger.error("予約カレンダー更新失敗: %s", e)
+    finally:
+        reserve_refresh_lock.release()
+
+def format_window(window):
+    start, end = window
+    return f"{start.strftime('%m/%d %H:%M')}〜{end.strftime('%H:%M')}"
+
+#返却期限(時間外の引き継ぎなどで翌日以降になる時は日付も付ける)
+def format_deadline(deadline, when):
+    return deadline.strftime('%H:%M' if deadline.date() == when.date() else '%m/%d %H:%M')
+
+# 返却期限タイマー(貸出ごとの単発ジョブ)####################################################################################
+#貸出中の鍵の返却期限(借りた・引き継いだ時刻の予約時間帯から決まる)
+def get_loan_deadline(key_name, borrow_time=None):
+    try:
+        since = datetime.strptime(borrow_time, "%Y/%m/%d %H:%M")
+    except (TypeError, ValueError):
+        since = datetime.now()
+    return reserve_calendar.deadline(key_name, since)
+
+#借りる・引き継ぎ時に期限ジョブを登録(同じ鍵のジョブは置き換え)。期限を過ぎていれば直後に実行
+#key_state.lock の中から呼ばれるので鍵状態は引数で受け取る
+def schedule_key_deadline(key_name, borrow_time):
+    if scheduler is None:
+        return
+    run_date = max(get_loan_deadline(key_name, borrow_time), datetime.now() + timedelta(seconds=5))
+    scheduler.add_job(run_notify_overdue_keys, 'date', run_date=run_date, id=f"deadline:{key_name}",
+                      jobstore="deadlines", replace_existing=True, misfire_grace_time=None)
+    logger.info("返却期限タイマー設定: %s → %s", key_name, run_date.strftime('%H:%M'))
+
+#返却時に期限ジョブを取り消す
+def cancel_key_deadline(key_name):
+    if scheduler is None:
+        return
+    try:
+        scheduler.remove_job(f"deadline:{key_name}", jobstore="deadlines")
+        logger.info("返却期限タイマー解除: %s", key_name)
+    except JobLookupError:
+        pass
+
+def cancel_all_deadlines():
+    if scheduler is not None:
+        scheduler.remove_all_jobs(jobstore="deadlines")
+
+#貸出中の鍵とタイマーを突き合わせる(起動時・予約変更時)。途中で貸出・返却が割り込まないようロックを持って行う
+def reschedule_all_deadlines():
+    if scheduler is None:
+        return
+    with key_state.lock:
+        for job in scheduler.get_jobs(jobstore="deadlines"):
+            if job.id.removeprefix("deadline:") not in key_state.holders:
+                job.remove()
+        for key_name, (_, borrow_time) in key_state.holders.items():
+            schedule_key_deadline(key_name, borrow_time)
 
 # LINE メッセージ送信######################################################################################################
 
-#Reply_tokenを使用=無料
-async def send_line_message(reply_token: str, message: str):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {LINE_ACCESS_TOKEN}"
-    }
-    payload = {
-        "replyToken": reply_token,
-        "messages": [{"type": "text", "text": message}]
-    }
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        for _ in range(3):
+#共有HTTPクライアント(keep-alive/接続プール)。常駐イベントループ上でのみ使用する
+LINE_TIMEOUT = float(config.get("line_timeout", 10.0))
+LINE_CONNECT_TIMEOUT = float(config.get("line_connect_timeout", 5.0))
+LINE_MAX_CONNECTIONS = int(config.get("line_max_connections", 20))
+LINE_MAX_KEEPALIVE = int(config.get("line_max_keepalive", 10))
+LINE_HTTP2 = bool(config.get("line_http2", False))#h2パッケージが必要
+line_client = None
+
+def get_line_client():
+    global line_client
+    if line_client is None:
+        http2 = LINE_HTTP2
+        if http2:
             try:
-                resp = await client.post(LINE_REPLY_URL, headers=headers, json=payload)
-                if resp.status_code == 200:
-                    logger.info(f"LINEメッセージ送信成功: {message}")
-                    return
-                await asyncio.sleep(1)
-            except Exception as e:
-                logger.error(f"LINEメッセージ送信失敗: {str(e)}")
-    logger.error(f"LINEメッセージ送信に失敗: {message}")
-
-#有料push
-async def push_line_message(user_id: str, message: str):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {LINE_ACCESS_TOKEN}"
-    }
-    payload = {
-        "to": user_id,
-        "messages": [{"type": "text", "text": message}]
-    }
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        try:
-            resp = await client.post(LINE_PUSH_URL, headers=headers, json=payload)
-            if resp.status_code == 200:
-                logger.info(f"LINEプッシュ送信成功: {message} (to {user_id})")
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("h2 が見つからないため HTTP/1.1 で接続します")
+                http2 = False
+        line_client = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {LINE_ACCESS_TOKEN}"},
+            timeout=httpx.Timeout(LINE_TIMEOUT, connect=LINE_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=LINE_MAX_CONNECTIONS,
+                                max_keepalive_connections=LINE_MAX_KEEPALIVE,
+                                keepalive_expiry=60.0),
+            http2=http2,
+        )
+        logger.info("LINE HTTPクライアント作成 (http2=%s)", http2)
+    return line_client
+
+async def close_line_client():
+    global line_client
+    if line_client is not None:
+        await line_client.aclose()
+        line_client = None
+        logger.info("LINE HTTPクライアントをクローズしました")
+
+#終了時フック
+def shutdown_line_client():
+    if event_loop is None or line_client is None:
+        return
+    try:
+        run_coroutine(close_line_client(), timeout=5)
+    except Exception as e:
+        logger.error("LINE HTTPクライアントのクローズに失敗: %s", e)
+
+atexit.register(shutdown_line_client)
+
+#LINE API 呼び出し(時間とステータスをメトリクスに記録。通信エラーは status="error")
+async def line_request(endpoint, method, url, **kwargs):
+    started = time.perf_counter()
+    status = "error"
+    try:
+        resp = await get_line_client().request(method, url, **kwargs)
+        status = str(resp.status_code)
+        return resp
+    finally:
+        line_request_seconds.observe(time.perf_counter() - started, endpoint)
+        line_requests.inc(endpoint, status)
+
+LINE_TEXT_LIMIT = 5000#1メッセージの最大文字数
+LINE_MAX_MESSAGES = 5#1回のreply/pushで送れるメッセージ数
+
+#push送信のレート制御(トークンバケット)。常駐イベントループ上でのみ使用する
+PUSH_CONCURRENCY = int(config.get("push_concurrency", 5))#同時送信数
+PUSH_RATE_PER_SEC = float(config.get("push_rate_per_sec", 10.0))#秒間push数
+PUSH_BURST = int(config.get("push_burst", 10))
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+push_bucket = TokenBucket(PUSH_RATE_PER_SEC, PUSH_BURST)
+
+def _retry_after_seconds(resp):
+    try:
+        return max(0.0, float(resp.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return None
+
+# LINE送信キュー(line_outbox)##############################################################################################
+#reply/push/multicast はすべてSQLiteの送信キューに積み、常駐イベントループ上の配信タスクが送る
+#失敗したら指数バックオフ(ゆらぎ付き)で再送し、OUTBOX_MAX_ATTEMPTS 回で dead として残す(黙って捨てない)
+#idempotency_key が同じ送信は1回だけ積む。push/multicast は X-Line-Retry-Key を付けてLINE側でも重複を防ぐ
+OUTBOX_BATCH = int(config.get("outbox_batch", 50))#1回に取り出す件数
+OUTBOX_MAX_ATTEMPTS = int(config.get("outbox_max_attempts", 8))
+OUTBOX_BACKOFF_BASE = float(config.get("outbox_backoff_base", 1.0))#秒。失敗するごとに2倍
+OUTBOX_BACKOFF_MAX = float(config.get("outbox_backoff_max", 300.0))#秒
+OUTBOX_CLAIM_SEC = float(config.get("outbox_claim_sec", 60))#取り出した行は送信中としてこの間他から取り出さない(落ちたら再送)
+OUTBOX_POLL_SEC = float(config.get("outbox_poll_sec", 5))#新しい行が無い時の確認間隔
+OUTBOX_KEEP_HOURS = float(config.get("outbox_keep_hours", 24))#送信済みの行を残す時間
+OUTBOX_DEAD_KEEP_DAYS = float(config.get("outbox_dead_keep_days", 30))#送信を諦めた行を残す日数
+REPLY_TOKEN_TTL = float(config.get("reply_token_ttl_sec", 60))#replyTokenの有効期間(イベント発生から)
+REPLY_FALLBACK_MARGIN = float(config.get("reply_fallback_margin_sec", 10))#残りがこれより短ければpushで送る
+
+outbox_stats = {"queued": 0, "duplicates": 0, "sent": 0, "retries": 0, "fallbacks": 0, "dead": 0}
+outbox_wakeup = None  # 常駐イベントループ上で作る asyncio.Event
+outbox_dispatcher = None
+
+#送信キューの1行(fallback_to: replyが使えない時のpush先 / expires_at: replyTokenの期限)
+def outbox_row(kind, target, messages, key=None, fallback_to=None, expires_at=None):
+    key = key or f"{kind}:{uuid.uuid4()}"
+    now = time.time()
+    return (key, kind, target if isinstance(target, str) else json.dumps(target), fallback_to,
+            json.dumps(messages[:LINE_MAX_MESSAGES], ensure_ascii=False), str(uuid.uuid5(uuid.NAMESPACE_URL, key)),
+            now, expires_at, now)
+
+#送信キューに積んで配信タスクを起こす(戻り値: 行idのリスト。積み済みの idempotency_key は既存の行id)
+def queue_line_messages(rows):
+    ids = []
+    with db_transaction() as conn:
+        for row in rows:
+            cur = conn.execute("""
+            INSERT OR IGNORE INTO line_outbox(idempotency_key, kind, target, fallback_to, messages, retry_key,
+                                              created_at, expires_at, next_attempt_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, row)
+            if cur.rowcount:
+                outbox_stats["queued"] += 1
+                ids.append(cur.lastrowid)
             else:
-                logger.error(f"LINEプッシュ送信失敗: {resp.status_code} - {resp.text}")
+                outbox_stats["duplicates"] += 1
+                ids.append(conn.execute("SELECT id FROM line_outbox WHERE idempotency_key=?", (row[0],)).fetchone()[0])
+    wake_outbox()
+    return ids
+
+def wake_outbox():
+    if outbox_wakeup is not None and event_loop is not None:
+        event_loop.call_soon_threadsafe(outbox_wakeup.set)
+
+#Reply_tokenを使用=無料。複数メッセージをまとめて返信(最大5件)。期限までに送れなければ fallback_to へのpushになる
+async def send_line_messages(reply_token: str, messages, fallback_to=None, expires_at=None):
+    expires_at = expires_at or time.time() + REPLY_TOKEN_TTL
+    queue_line_messages([outbox_row("reply", reply_token, messages, f"reply:{reply_token}", fallback_to, expires_at)])
+
+#有料push。message は1通(str)か最大5通のリスト(戻り値: 送信キューの行id)
+async def push_line_message(user_id: str, message, key=None):
+    messages = [message] if isinstance(message, str) else message
+    return queue_line_messages([outbox_row("push", user_id, messages, key)])[0]
+
+#複数宛先へのpush(1トランザクションで積む。戻り値: 宛先 → 送信キューの行id)
+async def fan_out_push(recipients, message):
+    messages = [message] if isinstance(message, str) else message
+    recipients = list(recipients)
+    return dict(zip(recipients, queue_line_messages([outbox_row("push", to, messages) for to in recipients])))
+
+#同じ内容を複数ユーザーに送る場合はmulticastで1リクエストにまとめる(グループ宛はpushのみ)
+LINE_MULTICAST_URL = f"{LINE_API_BASE}/v2/bot/message/multicast"
+USE_MULTICAST = bool(config.get("use_multicast", False))
+MULTICAST_MAX_RECIPIENTS = 500
+
+async def multicast_line_message(user_ids, messages):
+    return queue_line_messages([outbox_row("multicast", list(user_ids), messages)])[0]
+
+#宛先への配信(戻り値: 宛先 → 送信キューの行id。multicast でまとめた宛先は同じ行id)
+async def deliver_messages(recipients, messages):
+    users = [r for r in recipients if r.startswith("U")]
+    if not USE_MULTICAST or len(users) < 2:
+        return await fan_out_push(recipients, messages)
+    others = [r for r in recipients if not r.startswith("U")]
+    results = await fan_out_push(others, messages) if others else {}
+    for i in range(0, len(users), MULTICAST_MAX_RECIPIENTS):
+        chunk = users[i:i + MULTICAST_MAX_RECIPIENTS]
+        row_id = await multicast_line_message(chunk, messages)
+        results.update({u: row_id for u in chunk})
+    return results
+
+#replyの400のうち replyToken が無効(期限切れ・使用済み)なもの。LINEは {"message": "Invalid reply token"} を返す
+def is_invalid_reply_token(resp):
+    try:
+        message = str(resp.json().get("message", ""))
+    except (ValueError, AttributeError):
+        return False
+    return "reply token" in message.lower()
+
+#1行をLINEに送る(戻り値: sent/retry/fallback/dead, 待つ秒数(Retry-After), エラー内容)
+async def send_outbox_row(kind, target, messages, retry_key):
+    body = {"messages": [{"type": "text", "text": m} for m in messages]}
+    headers = {}
+    if kind == "reply":
+        url = LINE_REPLY_URL
+        body["replyToken"] = target
+    else:
+        url = LINE_PUSH_URL if kind == "push" else LINE_MULTICAST_URL
+        body["to"] = target if kind == "push" else json.loads(target)
+        headers["X-Line-Retry-Key"] = retry_key
+        await push_bucket.acquire()
+    try:
+        resp = await line_request(kind, "POST", url, json=body, headers=headers)
+    except Exception as e:
+        return "retry", None, f"{type(e).__name__}: {e}"
+    # 409 は同じ X-Line-Retry-Key の送信が受理済み
+    if resp.status_code == 200 or (resp.status_code == 409 and kind != "reply"):
+        return "sent", None, None
+    error = f"{resp.status_code} {resp.text[:200]}"
+    if kind == "reply" and resp.status_code == 400 and is_invalid_reply_token(resp):
+        return "fallback", None, error  # replyTokenの期限切れ・使用済み(本文の誤りなどはpushでも失敗するので切り替えない)
+    if resp.status_code == 429 or resp.status_code >= 500:
+        return "retry", _retry_after_seconds(resp), error
+    return "dead", None, error
+
+async def deliver_outbox_row(row, semaphore):
+    row_id, kind, target, fallback_to, messages, retry_key, created_at, expires_at, attempts = row
+    now = time.time()
+    if kind == "reply" and expires_at is not None and now > expires_at - REPLY_FALLBACK_MARGIN:
+        result, wait, error = "fallback", None, "replyTokenの期限切れ間近"
+    else:
+        async with semaphore:
+            result, wait, error = await send_outbox_row(kind, target, json.loads(messages), retry_key)
+    now = time.time()
+    conn = get_db_connection()
+    if result == "fallback" and fallback_to:
+        # pushに切り替えてすぐ送り直す(retry_key はそのまま)
+        conn.execute("UPDATE line_outbox SET kind='push', target=?, next_attempt_at=?, last_error=? WHERE id=?",
+                     (fallback_to, now, error, row_id))
+        outbox_stats["fallbacks"] += 1
+        outbox_deliveries.inc(kind, "fallback")
+        logger.warning("返信をpushに切り替えます(#%s → %s): %s", row_id, fallback_to, error)
+        wake_outbox()
+        return
+    attempts += 1
+    if result == "fallback" or (result == "retry" and attempts >= OUTBOX_MAX_ATTEMPTS):
+        result = "dead"
+    outbox_deliveries.inc(kind, result)
+    if result == "sent":
+        conn.execute("UPDATE line_outbox SET status='sent', attempts=?, sent_at=?, last_error=NULL WHERE id=?",
+                     (attempts, now, row_id))
+        outbox_stats["sent"] += 1
+        outbox_delay_seconds.observe(now - created_at, kind)
+        logger.info("LINE送信成功(#%s %s → %s): %s", row_id, kind, LogSnippet(target), LogSnippet(messages))
+    elif result == "retry":
+        backoff = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+        delay = max(wait or 0.0, random.uniform(backoff / 2, backoff))
+        conn.execute("UPDATE line_outbox SET attempts=?, next_attempt_at=?, last_error=? WHERE id=?",
+                     (attempts, now + delay, error, row_id))
+        outbox_stats["retries"] += 1
+        logger.warning("LINE送信失敗(#%s %s, %s回目): %s / %.1f秒後に再送します", row_id, kind, attempts, error, delay)
+    else:
+        conn.execute("UPDATE line_outbox SET status='dead', attempts=?, last_error=? WHERE id=?", (attempts, error, row_id))
+        outbox_stats["dead"] += 1
+        logger.error("LINE送信を諦めました(#%s %s → %s, %s回): %s / %s", row_id, kind, LogSnippet(target), attempts,
+                     error, LogSnippet(messages))
+
+#送る時刻になった行を取り出す(next_attempt_at を先送りして他の配信タスクから見えなくする)
+def claim_outbox_rows():
+    now = time.time()
+    with db_transaction() as conn:
+        return conn.execute("""
+        UPDATE line_outbox SET next_attempt_at = ? WHERE id IN (
+            SELECT id FROM line_outbox WHERE status='pending' AND next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT ?
+        ) RETURNING id, kind, target, fallback_to, messages, retry_key, created_at, expires_at, attempts
+        """, (now + OUTBOX_CLAIM_SEC, now, OUTBOX_BATCH)).fetchall()
+
+#次の再送時刻まで(最長 OUTBOX_POLL_SEC)
+def next_outbox_delay():
+    row = get_db_connection().execute(
+        "SELECT MIN(next_attempt_at) FROM line_outbox WHERE status='pending'").fetchone()
+    if row[0] is None:
+        return OUTBOX_POLL_SEC
+    return min(OUTBOX_POLL_SEC, max(0.05, row[0] - time.time()))
+
+async def dispatch_outbox():
+    semaphore = asyncio.Semaphore(PUSH_CONCURRENCY)
+    logger.info("LINE送信キューの配信を開始しました")
+    while True:
+        try:
+            outbox_wakeup.clear()
+            rows = sorted(claim_outbox_rows())
+            if rows:
+                results = await asyncio.gather(*(deliver_outbox_row(row, semaphore) for row in rows),
+                                               return_exceptions=True)
+                for row, result in zip(rows, results):
+                    if isinstance(result, Exception):
+                        logger.error("LINE送信キューの処理に失敗(#%s): %s", row[0], result)
+                continue
+            try:
+                await asyncio.wait_for(outbox_wakeup.wait(), next_outbox_delay())
+            except asyncio.TimeoutError:
+                pass
         except Exception as e:
-            logger.error(f"LINEプッシュ送信エラー: {str(e)}")
+            logger.error("LINE送信キューの配信でエラー: %s", e)
+            await asyncio.sleep(OUTBOX_POLL_SEC)
+
+#常駐イベントループ上で配信タスクを起動する
+def start_outbox_dispatcher():
+    global outbox_wakeup, outbox_dispatcher
+    if outbox_dispatcher is None or outbox_dispatcher.done():
+        outbox_wakeup = asyncio.Event()
+        outbox_dispatcher = event_loop.create_task(dispatch_outbox())
+
+#送信済み・送信を諦めた古い行を削除(スケジューラから)
+def purge_line_outbox():
+    now = time.time()
+    cur = get_db_connection().execute("""
+    DELETE FROM line_outbox WHERE (status='sent' AND sent_at < ?) OR (status='dead' AND next_attempt_at < ?)
+    """, (now - OUTBOX_KEEP_HOURS * 3600, now - OUTBOX_DEAD_KEEP_DAYS * 86400))
+    if cur.rowcount:
+        logger.info("LINE送信キューの古い記録を削除: %s 件", cur.rowcount)
+
+def get_outbox_stats():
+    counts = dict(get_db_connection().execute("SELECT status, COUNT(*) FROM line_outbox GROUP BY status").fetchall())
+    return {**outbox_stats, **{status: counts.get(status, 0) for status in ("pending", "sent", "dead")}}
+
+# 通知のまとめ送信(認証済みグループ宛)#####################################################################################
+NOTIFY_WINDOW_SEC = float(config.get("notify_window_sec", 60))#この間の通知を1回のpushにまとめる(0で即時)
+NOTIFY_RETRY_SEC = float(config.get("notify_retry_sec", 30))#送信キューに積めなかった通知を溜め直して再送するまでの秒数
+
+class NotificationAggregator:
+    def __init__(self, window: float):
+        self.window = window
+        self.pending = {}  # group_id -> [message]
+        self.timer = None
+        # requested: まとめなかった場合のpush数 / pushes: 実際のAPIリクエスト数
+        self.stats = {"requested": 0, "pushes": 0, "saved": 0, "digests": 0, "urgent": 0, "requeued": 0}
+
+    #priority="urgent" は待たずに(溜まっている分と一緒に)すぐ送る
+    async def submit(self, messages, priority="normal"):
+        groups = get_authenticated_group_ids()
+        if not groups:
+            return {}
+        for group_id in groups:
+            self.pending.setdefault(group_id, []).extend(messages)
+        self.stats["requested"] += len(groups) * len(messages)
+        if priority == "urgent" or self.window <= 0:
+            if priority == "urgent":
+                self.stats["urgent"] += 1
+            return await self.flush()
+        if self.timer is None:
+            self.schedule(self.window)
+        return {}
+
+    def schedule(self, delay):
+        self.timer = asyncio.get_running_loop().call_later(delay, lambda: asyncio.ensure_future(self.flush_from_timer()))
+
+    #タイマーから呼ばれた時は例外を受け取る相手がいないのでここでログに残す
+    async def flush_from_timer(self):
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("グループ通知のまとめ送信に失敗")
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return {}
+        # 同じ内容のグループはまとめて配信
+        by_content = {}
+        for group_id, messages in pending.items():
+            by_content.setdefault(tuple(messages), []).append(group_id)
+        results = {}
+        failed = 0
+        for messages, groups in by_content.items():
+            try:
+                queued = await deliver_messages(groups, fit_messages(list(messages)))
+            except Exception as e:
+                # 送信キューに積めなかった分は、待っている間に届いた通知より前に溜め直して後で再送する
+                logger.error("グループ通知を送信キューに積めませんでした(%s グループ、%s秒後に再送): %s", len(groups), NOTIFY_RETRY_SEC, e)
+                for group_id in groups:
+                    self.pending[group_id] = list(messages) + self.pending.get(group_id, [])
+                failed += len(groups)
+                continue
+            if len(messages) > 1:
+                self.stats["digests"] += 1
+            results.update(queued)
+            self.stats["pushes"] += len(set(queued.values()))
+        if failed:
+            self.stats["requeued"] += failed
+            if self.timer is not None:
+                self.timer.cancel()
+            self.schedule(NOTIFY_RETRY_SEC)
+        self.stats["saved"] = self.stats["requested"] - self.stats["pushes"]
+        logger.info("グループ通知送信: %s グループ / 節約したpush数 累計 %s", len(pending) - failed, self.stats['saved'])
+        return results
+
+notifier = NotificationAggregator(NOTIFY_WINDOW_SEC)
+
+#終了時に溜まっている通知を送る
+def flush_pending_notifications():
+    if event_loop is None or not notifier.pending:
+        return
+    try:
+        run_coroutine(notifier.flush(), timeout=10)
+    except Exception as e:
+        logger.error("保留中の通知送信に失敗: %s", e)
+
+atexit.register(flush_pending_notifications)
 
 # 未返却通知用スケジューラ #################################################################################################
 async def notify_overdue_keys():
-    now = datetime.now().strftime("%H:%M")
-    today = datetime.today().strftime("%Y/%m/%d")
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT key_name, holder_id FROM key_holders")
-    rows = c.fetchall()
+    now = datetime.now()
 
-    # ユーザー単位で鍵をまとめる
+    # 鍵ごとの返却期限(予約カレンダーから)を過ぎたものをユーザー単位でまとめる
     overdue_dict = {}
-    for key_name, holder_id in rows:
-        # デフォルト終了時間
-        default_end_time = "20:55"
-        end_time = default_end_time
-
-        # シートでその日の終了時間を取得
-        date_cells = sheet2.findall(today)
-        if date_cells:
-            for cell in date_cells:
-                time_range = sheet2.cell(cell.row, cell.col + 1).value
-                try:
-                    _, end_hour = time_range.split("-")
-                    end_hour = int(end_hour)
-                    if end_hour < 21:
-                        end_time = f"{end_hour}:00"
-                except Exception:
-                    continue
-
-        if now > end_time:
+    for key_name, (holder_id, borrow_time) in key_state.snapshot().items():
+        if now >= get_loan_deadline(key_name, borrow_time):
             overdue_dict.setdefault(holder_id, []).append(key_name)
 
     # 通知処理
@@ -269,457 +2191,988 @@ async def notify_overdue_keys():
             key_str = "・".join(notified_keys)
             message = f"{key_str}の返却期限が過ぎています。{user_name} さん、返却してください。"
             message_author = f"{key_str}の返却期限が過ぎています。{user_name} さんへ通知しました。"
-            await push_line_message(holder_id, message)
-            await push_to_authenticated_groups(message_author)
+            await push_line_message(holder_id, message, key=f"overdue:{holder_id}:{date.today()}:{key_str}")
+            await push_to_authenticated_groups(message_author, priority="urgent")
             for key_name in notified_keys:
-                log_key_action("通知", key_name, user_name)
-            logger.warning(f"通知:{key_str} の返却期限が過ぎています。. {user_name} と認証済みグループに通知しました。")
+                log_key_action("通知", key_name, user_name, holder_id)
+            logger.warning("通知:%s の返却期限が過ぎています。. %s と認証済みグループに通知しました。", key_str, user_name)
 
         except Exception as e:
-            logger.error(f"未返却通知失敗（{holder_id}）: {str(e)}")
+            logger.error("未返却通知失敗（%s）: %s", holder_id, e)
 
 
 def already_notified_today(user_id, key_name):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
-    today = date.today().strftime("%Y/%m/%d")
-    user_name = get_user_name(user_id)
+    today_start = int(datetime.combine(date.today(), datetime.min.time()).timestamp())
     c.execute("""
-        SELECT 1 FROM key_logs 
-        WHERE action='通知' AND key_name=? AND user_name=? AND timestamp LIKE ?
-    """, (key_name, user_name, f"{today}%"))
+        SELECT 1 FROM key_logs
+        WHERE action='通知' AND key_name=? AND holder_id=? AND ts >= ?
+        LIMIT 1
+    """, (key_name, user_id, today_start))
     result = c.fetchone()
-    conn.close()
     return result is not None
 
 
 
-# Webhook エンドポイント###################################################################################################
-@app.route("/webhook", methods=["POST"])
-def webhook():
-    data = request.json
-    logger.info(f"Webhook受信: {data}")
-
-    for event in data.get("events", []):
-        if event.get("type") != "message" or event["message"].get("type") != "text":
-            continue
-
-        reply_token = event.get("replyToken")
-        source = event["source"]
-        user_id = source.get("userId")
-        group_id = source.get("groupId")
-        text = event["message"]["text"].strip()
-
-        conn = get_db_connection()
-        c = conn.cursor()
-
-
-        # 学籍番号登録
-        if user_id and text.lower().startswith("番号:"):
-            no_upper = text.split("番号:")[1].strip().upper()
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-
-            # 学籍番号チェック
-            c.execute("SELECT student_no, name FROM users WHERE line_id=?", (user_id,))
-            if c.fetchone():
-                reply = "すでに登録済みです。"
-            else:
-                try:
-                    # sheet1から学籍番号を検索
-                    found_cells = sheet1.findall(no_upper)
-                    if found_cells:
-                        # 最初に見つかったセルを使用
-                        cell = found_cells[0]
-                        name = sheet1.cell(cell.row, cell.col + 1).value  # 右隣のセルを名前として取得
-                        c.execute("INSERT INTO users(line_id, student_no, name) VALUES (?, ?, ?)", (user_id, no_upper, name))
-                        conn.commit()
-                        reply = f"登録完了：{name}（{no_upper}）"
-                    else:
-                        reply = "学籍番号が見つかりません。"
-                except Exception as e:
-                    reply = f"エラーが発生しました：{str(e)}"
-            conn.close()
-            asyncio.run(send_line_message(reply_token, reply))
-            continue
-
-    #グループ認証
-        if group_id and text.startswith(AUTH_CODE):#認証番号
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute("INSERT OR IGNORE INTO groups(group_id) VALUES (?)", (group_id,))
-            conn.commit()
-            conn.close()
-            reply = "このグループを認証済みに登録しました。"
-            asyncio.run(send_line_message(reply_token, reply))
-            continue
-
-    #認証グループ削除
-        if group_id and text.strip() == "OPUS&Delete":
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute("DELETE FROM groups WHERE group_id=?", (group_id,))
-            conn.commit()
-            conn.close()
-            reply = "このグループを認証済みグループから削除しました。"
-            asyncio.run(send_line_message(reply_token, reply))
+# イベントワーカー#########################################################################################################
+EVENT_WORKERS = int(config.get("event_workers", 4))#同時処理数
+EVENT_QUEUE_MAX = int(config.get("event_queue_max", 1000))#キュー上限
+
+event_loop = None
+event_queue = None
+event_loop_lock = threading.Lock()
+event_stats = {"received": 0, "processed": 0, "failed": 0, "dropped": 0, "returned": 0}
+event_latencies = deque(maxlen=500)#直近の受信〜処理完了時間(ms)
+
+def _event_loop_main(ready):
+    global event_loop, event_queue
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    event_queue = asyncio.Queue(maxsize=EVENT_QUEUE_MAX)
+    for i in range(EVENT_WORKERS):
+        loop.create_task(event_worker(i))
+    event_loop = loop
+    start_outbox_dispatcher()
+    ready.set()
+    loop.run_forever()
+
+def start_event_workers():  # 常駐イベントループ起動(初回のみ)
+    with event_loop_lock:
+        if event_loop is None:
+            ready = threading.Event()
+            threading.Thread(target=_event_loop_main, args=(ready,), name="keynow-events", daemon=True).start()
+            ready.wait()
+            logger.info("イベントワーカー起動: workers=%s, queue_max=%s", EVENT_WORKERS, EVENT_QUEUE_MAX)
+    return event_loop
+
+#inbox_id は受信箱から取り出した時の行id(リーダーを降りたら受信箱に戻すのに使う)
+def _put_events(events, received_at, request_id, inbox_id=None):
+    event_stats["received"] += len(events)
+    try:
+        event_queue.put_nowait((events, received_at, request_id, inbox_id))
+    except asyncio.QueueFull:
+        event_stats["dropped"] += len(events)
+        logger.error("イベントキューが満杯のため破棄しました: %s", [e.get('webhookEventId') for e in events])
+
+#1回のWebhookのイベントをまとめて1件としてキューに積む
+#request_id はログの相関ID(処理側のログにも引き継ぐ)
+def enqueue_events(events, request_id=None):
+    if not events:
+        return
+    loop = start_event_workers()
+    loop.call_soon_threadsafe(_put_events, list(events), time.perf_counter(), request_id)
+
+#他スレッドから常駐ループ上でコルーチンを実行し結果を待つ
+def run_coroutine(coro, timeout=None):
+    loop = start_event_workers()
+    return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+async def event_worker(worker_id):
+    while True:
+        events, received_at, request_id, inbox_id = await event_queue.get()
+        if inbox_id is not None and not leader_election.holds_lease():
+            # リーダーを降りた後は古い鍵状態で処理せず、受信箱に戻して新しいリーダーに任せる
+            return_to_inbox(inbox_id, events, received_at, request_id)
+            event_queue.task_done()
             continue
-
-
-
-    # 鍵管理（借りる、返却、引き継ぎ）
-        parts = text.split()
-        logger.info(f"Command parsed: {parts}")
-
-        if len(parts) == 2 and parts[0] in ["借りる", "返却", "引き継ぎ"]:
-            action, key_name = parts
-            logger.info(f"メッセージを受信: {action}, 鍵種類: {key_name}")
-            valid_keys = ["音倉", "音練", "両方"]
-            if key_name not in valid_keys:
-                reply = "鍵の種類は「音倉」「音練」「両方」のいずれかを記入してください。"
-                asyncio.run(send_line_message(reply_token, reply))
-                continue
-
-            # 「両方」の場合、音倉と音練をそれぞれ処理する
-            keys_to_process = ["音倉", "音練"] if key_name == "両方" else [key_name]
-            logger.info(f"Keys to process: {keys_to_process}")
-            #学籍番号登録チェック
-            if not is_user_registered(user_id):
-                reply = "学籍番号が登録されていません。まず「番号:あなたの学籍番号」で登録してください。"
-                asyncio.run(send_line_message(reply_token, reply))
-                continue
-
-            now = datetime.now().strftime("%Y/%m/%d %H:%M")
+        started = time.perf_counter()
+        log_token = log_request_id.set(request_id)
+        try:
+            await process_event_batch(events)
+            event_stats["processed"] += len(events)
+        except Exception as e:
+            event_stats["failed"] += 1
+            logger.error("イベント処理エラー(worker%s): %s", worker_id, e)
+        finally:
+            event_queue.task_done()
+            done = time.perf_counter()
+            event_latencies.append((done - received_at) * 1000)
+            event_seconds.observe(done - received_at)
+            logger.info("イベント処理完了(worker%s): 待機 %.1fms / 処理 %.1fms / 残キュー %s", worker_id,
+                        (started - received_at) * 1000, (done - started) * 1000, event_queue.qsize())
+            log_request_id.reset(log_token)
+
+# 再送イベントの重複排除(webhookEventId)#################################################################################
+DEDUPE_CACHE_SIZE = int(config.get("dedupe_cache_size", 10000))
+DEDUPE_TTL_HOURS = float(config.get("dedupe_ttl_hours", 24))
+
+seen_event_ids = OrderedDict()
+dedupe_stats = {"duplicates": 0, "checked": 0}
+
+#初めてのイベントならTrue、処理済み(処理中)ならFalse。常駐イベントループ上で呼ぶ
+#DBへの受信記録は claims に積み、バッチの書き込み・返信と同じトランザクションで書く
+def claim_event(event, claims):
+    event_id = event.get("webhookEventId")
+    if not event_id:
+        return True
+    dedupe_stats["checked"] += 1
+    if event_id in seen_event_ids:
+        seen_event_ids.move_to_end(event_id)
+        dedupe_stats["duplicates"] += 1
+        return False
+    seen_event_ids[event_id] = True
+    if len(seen_event_ids) > DEDUPE_CACHE_SIZE:
+        seen_event_ids.popitem(last=False)
+    # 再起動をまたいだ再送はDBで判定(主キーで引くのでO(1))
+    if get_db_connection().execute("SELECT 1 FROM webhook_events WHERE event_id=?", (event_id,)).fetchone():
+        dedupe_stats["duplicates"] += 1
+        return False
+    claims.append((event_id, time.time()))
+    return True
+
+#期限切れの記録を削除(スケジューラから)
+def purge_webhook_events():
+    cutoff = time.time() - DEDUPE_TTL_HOURS * 3600
+    cur = get_db_connection().execute("DELETE FROM webhook_events WHERE received_at < ?", (cutoff,))
+    if cur.rowcount:
+        logger.info("受信済みイベント記録を削除: %s 件", cur.rowcount)
+
+#イベントを順に処理し、書き込みは1トランザクション、返信はreplyTokenごと、通知はグループごとに1回で送る
+#鍵の保有者の変更だけは他のバッチとの順序を守るため KeyStateEngine がその場で確定する
+async def process_event_batch(events):
+    claims = []
+    events = [event for event in events if claim_event(event, claims)]
+    if not events:
+        return
+    batch = EventBatch(events, claims)
+    token = current_batch.set(batch)
+    try:
+        for index, event in enumerate(events):
+            batch.index = index
+            event_token = log_event_id.set(event.get("webhookEventId"))
             try:
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-
-                for key_name in keys_to_process:
-                    try:
-                        # 借りる処理
-                        if action == "借りる":
-                            logger.info(f"借りる操作開始: {key_name}")
-                            # 両方借りる場合、両方鍵があるか確認
-                            if len(keys_to_process) == 2 and key_name == "音倉":
-                                c.execute("SELECT holder_id FROM key_holders WHERE key_name IN (?, ?)", ("音倉", "音練"))
-                                holders = c.fetchall()
-                                if len(holders) > 0:
-                                    # 既にどちらかが借りられている場合
-                                    borrowed_keys = [h[0] for h in holders]
-                                    reply = "音倉または音練のどちらかが既に借りられています。"
-                                    logger.warning(f"借りる操作失敗: 音倉・音練のどちらかが既に借りられている: {borrowed_keys}")
-                                    asyncio.run(send_line_message(reply_token, reply))
-                                    continue
-
-                                # 両方を一括で借りる
-                                user_name = get_user_name(user_id)
-                                line_name = asyncio.run(get_line_name(user_id))
-                                display = f"{user_name}さん（LINE名:{line_name}）"
-                                c.execute("INSERT INTO key_holders(key_name, holder_id, borrow_time) VALUES (?, ?, ?)",
-                                          ("音倉", user_id, now))
-                                c.execute("INSERT INTO key_holders(key_name, holder_id, borrow_time) VALUES (?, ?, ?)",
-                                          ("音練", user_id, now))
-                                conn.commit()
-                                log_key_action("借りる", "音倉・音練", user_name)
-                                reply = f"音倉・音練 を {user_name} さんが借りました。"
-                                auth_reply = f"音倉・音練 を {display} が借りました。"
-                                logger.info(f"両方借りる操作成功: 音倉・音練 を {user_name} さんが借りました")
-                                asyncio.run(send_line_message(reply_token, reply))
-                                asyncio.run(push_to_authenticated_groups(auth_reply))
-                                break
-
-                            # 個別の鍵借りる処理
-                            c.execute("SELECT holder_id FROM key_holders WHERE key_name=?", (key_name,))
-                            result = c.fetchone()
-
-                            if result:
-                                reply = f"{key_name} は既に借りられています。"
-                                logger.warning(f"借りる操作失敗: {key_name} は既に借りられています")
-                            else:
-                                # 鍵を借りる処理
-                                user_name = get_user_name(user_id)
-                                line_name = asyncio.run(get_line_name(user_id))
-                                display = f"{user_name}さん（LINE名:{line_name}）"
-
-                                c.execute("INSERT INTO key_holders(key_name, holder_id, borrow_time) VALUES (?, ?, ?)",
-                                          (key_name, user_id, now))
-                                conn.commit()
-                                log_key_action("借りる", key_name, user_name)
-                                reply = f"{key_name} を {display} が借りました。"
-                                logger.info(f"借りる操作成功: {key_name} を {user_name} さんが借りました")
-
-                                # メッセージ送信
-                                asyncio.run(send_line_message(reply_token, reply))
-                                asyncio.run(push_to_authenticated_groups(reply))
-                        # 返却処理
-                        elif action == "返却":
-                            logger.info(f"返却操作開始: {key_name}")
-                            # 両方返却の場合、事前に所有者チェック
-                            if len(keys_to_process) == 2 and key_name == "音倉":
-                                c.execute("SELECT holder_id FROM key_holders WHERE key_name IN (?, ?)", ("音倉", "音練"))
-                                holders = c.fetchall()
-                                if len(holders) != 2 or holders[0][0] != holders[1][0]:
-                                    reply = "音倉と音練は同じ所有者でないため、同時に返却できません。"
-                                    logger.warning(f"返却操作失敗: 音倉と音練の所有者が異なる")
-                                    asyncio.run(send_line_message(reply_token, reply))
-                                    continue
-
-                                # 両方の鍵を一括で返却
-                                c.execute("DELETE FROM key_holders WHERE key_name IN (?, ?)", ("音倉", "音練"))
-                                conn.commit()
-                                user_name = get_user_name(user_id)
-                                line_name = asyncio.run(get_line_name(user_id))
-                                display = f"{user_name}さん（LINE名:{line_name}）"
-                                log_key_action("返却", "音倉・音練", user_name)
-                                reply = f"音倉・音練 を {display} が返却しました。"
-                                logger.info(f"返却操作成功: 音倉・音練 を {user_name} さんが返却しました")
-                                asyncio.run(send_line_message(reply_token, reply))
-                                asyncio.run(push_to_authenticated_groups(reply))
-                                continue
-
-                            # 個別の鍵返却
-                            c.execute("SELECT holder_id FROM key_holders WHERE key_name=?", (key_name,))
-                            holder = c.fetchone()
-                            if holder and holder[0] == user_id:
-                                c.execute("DELETE FROM key_holders WHERE key_name=?", (key_name,))
-                                conn.commit()
-                                user_name = get_user_name(user_id)
-                                line_name = asyncio.run(get_line_name(user_id))
-                                display = f"{user_name}さん（LINE名:{line_name}）"
-                                log_key_action("返却", key_name, user_name)
-                                reply = f"{key_name} を {display} さんが返却しました。"
-                                logger.info(f"返却操作成功: {key_name} を {user_name} さんが返却しました")
-                                asyncio.run(send_line_message(reply_token, reply))
-                                asyncio.run(push_to_authenticated_groups(reply))
-                            else:
-                                reply = f"{key_name} は借りられていません、または他のユーザーが所有しています。"
-                                logger.warning(f"返却操作失敗: {key_name} が他のユーザー所有")
-                                asyncio.run(send_line_message(reply_token, reply))
-
-                        # 引き継ぎ処理
-                        elif action == "引き継ぎ":
-                            logger.info(f"引き継ぎ操作開始: {key_name}")
-                            # 両方引き継ぎの場合、事前に所有者チェック
-                            if len(keys_to_process) == 2 and key_name == "音倉":
-                                c.execute("SELECT holder_id FROM key_holders WHERE key_name IN (?, ?)", ("音倉", "音練"))
-                                holders = c.fetchall()
-                                if len(holders) != 2 or holders[0][0] != holders[1][0]:
-                                    reply = "音倉と音練は同じ所有者でないため、同時に引き継ぎできません。"
-                                    logger.warning(f"引き継ぎ操作失敗: 音倉と音練の所有者が異なる")
-                                    asyncio.run(send_line_message(reply_token, reply))
-                                    continue
-
-                                # 両方の鍵を一括で引き継ぎ
-                                user_name = get_user_name(user_id)
-                                line_name = asyncio.run(get_line_name(user_id))
-                                display = f"{user_name}さん（LINE名:{line_name}）"
-                                c.execute("UPDATE key_holders SET holder_id=?, borrow_time=? WHERE key_name IN (?, ?)",
-                                          (user_id, now, "音倉", "音練"))
-                                conn.commit()
-                                log_key_action("引き継ぎ", "音倉・音練", user_name)
-                                reply = f"音倉・音練 を {display} に引き継ぎました。"
-                                logger.info(f"引き継ぎ操作成功: 音倉・音練 を {display} に引き継ぎました")
-                                asyncio.run(send_line_message(reply_token, reply))
-                                asyncio.run(push_to_authenticated_groups(reply))
-                                break
-
-                            c.execute("SELECT holder_id FROM key_holders WHERE key_name=?", (key_name,))
-                            holder = c.fetchone()
-                            if holder:
-                                # 個別引き継ぎ実行
-                                user_name = get_user_name(user_id)
-                                line_name = asyncio.run(get_line_name(user_id))
-                                display = f"{user_name}さん（LINE名:{line_name}）"
-                                c.execute(
-                                    "UPDATE key_holders SET holder_id=?, borrow_time=? WHERE key_name=?",
-                                    (user_id, now, key_name)
-                                )
-                                conn.commit()
-                                log_key_action("引き継ぎ", key_name, user_name)
-                                reply = f"{key_name} を {display} に引き継ぎました。"
-                                logger.info(f"引き継ぎ操作成功:{key_name} を {display}に引き継ぎました")
-                                asyncio.run(send_line_message(reply_token, reply))
-                                asyncio.run(push_to_authenticated_groups(reply))
-                            else:
-                                # 鍵がそもそも借りられていない場合
-                                reply = f"{key_name} は現在借りられていません。"
-                                logger.warning(f"引き継ぎ失敗: {key_name} は借りられていません")
-                                asyncio.run(send_line_message(reply_token, reply))
-                            continue
-
-                    except Exception as e:
-                        error_message = f"操作中にエラーが発生しました: {str(e)}"
-                        logger.error(error_message)
-                        reply = error_message
-                        asyncio.run(send_line_message(reply_token, reply))
-
+                await handle_event(event)
+            except Exception as e:
+                event_stats["failed"] += 1
+                logger.error("イベント処理エラー(%s): %s", event.get('webhookEventId'), e)
             finally:
-                if conn:
-                    conn.close()
-                    logger.info("データベース接続をクローズしました")
-
-
-
+                log_event_id.reset(event_token)
+    finally:
+        current_batch.reset(token)
+    await flush_event_batch(batch)
+
+#LINEの1回あたり5通の制限に収める(溢れた分は最後の1通にまとめる)
+def fit_messages(messages):
+    if len(messages) <= LINE_MAX_MESSAGES:
+        return messages
+    head = messages[:LINE_MAX_MESSAGES - 1]
+    tail = "\n\n".join(messages[LINE_MAX_MESSAGES - 1:])
+    return head + [tail[:LINE_TEXT_LIMIT]]
+
+#書き込みに失敗したイベントの返信はエラーに差し替える
+def reply_rows(batch):
+    replies = dict(batch.replies)
+    for index, error in batch.failed.items():
+        reply_token = batch.events[index].get("replyToken")
+        if reply_token in replies:
+            replies[reply_token] = [f"操作中にエラーが発生しました: {str(error)}"]
+    return [outbox_row("reply", t, fit_messages(m), f"reply:{t}", *batch.reply_to.get(t, (None, None)))
+            for t, m in replies.items()]
+
+def apply_writes(conn, writes):
+    for _, sql, params, many in writes:
+        if many:
+            conn.executemany(sql, params)
+        else:
+            conn.execute(sql, params)
+
+def record_claims(conn, claims):
+    conn.executemany("INSERT OR IGNORE INTO webhook_events(event_id, received_at) VALUES (?, ?)", claims)
+
+#まとめて書けなかった時はイベントごとに書き直し、書けなかったイベントだけを失敗にする
+def apply_writes_per_event(batch, writes):
+    by_event = {}
+    for write in writes:
+        by_event.setdefault(write[0], []).append(write)
+    for index, event_writes in by_event.items():
+        try:
+            with db_transaction() as conn:
+                apply_writes(conn, event_writes)
+        except Exception as e:
+            logger.error("イベントの書き込み失敗(%s): %s", batch.events[index].get("webhookEventId"), e)
+            batch.failed[index] = e
+            batch.users.pop(batch.events[index]["source"].get("userId"), None)
+
+#ここまでに保留した書き込みを今すぐ確定する(同じバッチの後のイベントが登録済みを前提に鍵を動かす前に呼ぶ)
+def commit_batch_writes(batch):
+    writes, batch.writes = batch.writes, []
+    if not writes:
+        return
+    try:
+        with db_transaction() as conn:
+            apply_writes(conn, writes)
+    except Exception as e:
+        logger.error("バッチ書き込み失敗(%s件): %s", len(writes), e)
+        apply_writes_per_event(batch, writes)
 
+#書き込み・受信記録・返信は同じトランザクションで確定する(返信が送信キューに積まれずに消えることが無い)
+#失敗した時は書き込みをイベントごとに確定し直し、書けなかったイベントの返信だけをエラーにして通知も送らない
+async def flush_event_batch(batch):
+    writes, batch.writes = batch.writes, []
+    try:
+        with db_transaction() as conn:
+            apply_writes(conn, writes)
+            record_claims(conn, batch.claims)
+            queue_line_messages(reply_rows(batch))
+    except Exception as e:
+        logger.error("バッチ書き込み失敗(%s件): %s", len(writes), e)
+        apply_writes_per_event(batch, writes)
+        try:
+            with db_transaction() as conn:
+                record_claims(conn, batch.claims)
+                queue_line_messages(reply_rows(batch))
+        except Exception as e:
+            logger.error("返信を送信キューに積めませんでした: %s", e)
+    for priority in ("normal", "urgent"):
+        messages = [m for m, p, index in batch.group_messages if p == priority and index not in batch.failed]
+        if messages:
+            await notifier.submit(messages, priority)
+
+def get_event_stats():
+    latencies = sorted(event_latencies)
+
+    def percentile(p):
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))], 1)
+
+    return {
+        **event_stats,
+        "workers": EVENT_WORKERS,
+        "queue_depth": event_queue.qsize() if event_queue else 0,
+        "latency_ms_p50": percentile(0.50),
+        "latency_ms_p95": percentile(0.95),
+        "latency_ms_max": percentile(1.0),
+    }
 
-        # 鍵確認
-        if text == "鍵確認":
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute("SELECT key_name, holder_id, borrow_time FROM key_holders")
-            rows = c.fetchall()
-            if not rows:
-                reply = "現在、貸出中の鍵はありません。"
+# 複数ワーカー運用(イベント受信箱とリーダー選出)###########################################################################
+#WSGIサーバーの複数ワーカーで動かす場合は create_app() から起動する
+#Webhookはどのワーカーでも受信箱(event_inbox)に積んですぐ返し、SQLiteの貸出期限(leader_lease)を持つ1プロセスだけが
+#受信箱の処理とスケジューラを受け持つ(鍵状態・通知のまとめ・重複排除のメモリはリーダーの1か所だけになる)
+LEADER_LEASE_SEC = float(config.get("leader_lease_sec", 15))#更新が途絶えてから他のワーカーが引き継ぐまで
+LEADER_HEARTBEAT_SEC = float(config.get("leader_heartbeat_sec", 5))#期限の更新間隔
+INBOX_POLL_SEC = float(config.get("inbox_poll_sec", 0.1))#受信箱が空の時の確認間隔
+INBOX_BATCH = 100#1回に取り出す件数
+
+MULTI_WORKER = False
+
+class LeaderElection:
+    def __init__(self, name, on_elected, on_demoted):
+        self.name = name
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.is_leader = False
+        self.term = None
+        self.valid_until = 0.0  # 自分の時計で期限を少し手前に見積もる(monotonic)
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.stats = {"elections": 0, "demotions": 0, "renewals": 0, "errors": 0}
+
+    def start(self):
+        if self.thread is None:
+            self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+            self.thread = threading.Thread(target=self._run, name="keynow-leader", daemon=True)
+            self.thread.start()
+            atexit.register(self.release)
+
+    #期限切れか自分が持っていれば取得・更新する(戻り値: 取得できたか, 現在の保持者)
+    def _try_acquire(self):
+        started = time.monotonic()
+        now = time.time()
+        with db_transaction() as conn:
+            row = conn.execute("SELECT holder, expires_at, term FROM leader_lease WHERE name=?", (self.name,)).fetchone()
+            if row and row[0] != self.worker_id and row[1] > now:
+                return False, row[0]
+            if row and row[0] == self.worker_id:
+                term = row[2]
             else:
-                parts = []
-                for key_name, holder_id, borrow_time in rows:
-                    holder_name = get_user_name(holder_id)
-                    line_name = asyncio.run(get_line_name(holder_id))
-                    display = f"{holder_name}さん（LINE名:{line_name}）"
-                    parts.append(f"{key_name} → {display} ({borrow_time})")
-                reply = "\n".join(parts)
-            conn.close()
-            asyncio.run(send_line_message(reply_token, reply))
-            continue
+                term = (row[2] if row else 0) + 1  # 引き継ぐたびに増える
+            conn.execute("INSERT OR REPLACE INTO leader_lease(name, holder, expires_at, term) VALUES (?, ?, ?, ?)",
+                         (self.name, self.worker_id, now + LEADER_LEASE_SEC, term))
+        self.term = term
+        self.valid_until = started + LEADER_LEASE_SEC - LEADER_HEARTBEAT_SEC / 2
+        return True, self.worker_id
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                acquired, holder = self._try_acquire()
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error("リーダー期限の更新に失敗: %s", e)
+                acquired, holder = self.is_leader and time.monotonic() < self.valid_until, None
+            if acquired and not self.is_leader:
+                self.is_leader = True
+                self.stats["elections"] += 1
+                logger.info("リーダーに選出されました: %s (term %s)", self.worker_id, self.term)
+                self._callback(self.on_elected)
+            elif acquired:
+                self.stats["renewals"] += 1
+            elif self.is_leader:
+                self.is_leader = False
+                self.stats["demotions"] += 1
+                logger.warning("リーダーを降りました: %s (現在のリーダー %s)", self.worker_id, holder)
+                self._callback(self.on_demoted)
+            self.stop_event.wait(LEADER_HEARTBEAT_SEC)
+
+    def _callback(self, func):
+        try:
+            func()
+        except Exception as e:
+            logger.error("リーダー切り替え処理に失敗(%s): %s", func.__name__, e)
 
-        if text == "履歴確認":
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute("SELECT group_id FROM groups WHERE group_id=?", (group_id,))
-            if c.fetchone():
-                asyncio.run(send_history(reply_token))
-            else:
-                reply = "このグループは認証されていません。"
-                asyncio.run(send_line_message(reply_token, reply))
-            conn.close()
-            continue
+    def holds_lease(self):
+        return self.is_leader and time.monotonic() < self.valid_until
 
-        if text == "リセット鍵情報":
-            # 認証済みグループか確認
-            c.execute("SELECT group_id FROM groups WHERE group_id=?", (group_id,))
-            if c.fetchone():
-                # リセット実行
-                try:
-                    asyncio.run(human_reset_key_holders())
-                    reply = "鍵の保有情報をリセットしました。"
-                    logger.info("鍵保有情報リセット実行")
-                except Exception as e:
-                    reply = f"リセット中にエラーが発生しました: {str(e)}"
-                    logger.error(f"リセット失敗: {str(e)}")
-            else:
-                reply = "このグループは認証されていません。"
-                logger.warning("認証されていないグループからリセットコマンドが送信されました。")
-            conn.close()
-            asyncio.run(send_line_message(reply_token, reply))
-            continue
+    #終了時は期限を手放してすぐ引き継がせる
+    def release(self):
+        self.stop_event.set()
+        if not self.is_leader:
+            return
+        self.is_leader = False
+        try:
+            get_db_connection().execute("DELETE FROM leader_lease WHERE name=? AND holder=?", (self.name, self.worker_id))
+            logger.info("リーダーを返上しました: %s", self.worker_id)
+        except Exception as e:
+            logger.error("リーダー返上に失敗: %s", e)
+
+    def snapshot(self):
+        return {"enabled": MULTI_WORKER, "worker_id": self.worker_id, "is_leader": self.is_leader,
+                "term": self.term, **self.stats}
+
+def is_scheduler_leader():
+    return not MULTI_WORKER or leader_election.holds_lease()
+
+#リーダーになったら鍵状態を読み直し、受信箱の処理とスケジューラを始める
+def become_leader():
+    google_sheets.start()  # 名簿・予約シートを使うのはリーダーだけ
+    key_state.load()
+    start_event_workers().call_soon_threadsafe(start_inbox_poller)
+    start_scheduler()
+
+def step_down():
+    global scheduler
+    if scheduler is not None:
+        scheduler.shutdown(wait=False)
+        scheduler = None
+    # 受信箱の処理は poll_event_inbox がリーダーでなくなったのを見て止まる
+
+leader_election = LeaderElection("scheduler", become_leader, step_down)
+
+#受信したイベントを受信箱に積む(各ワーカーのリクエストスレッドから)
+def put_event_inbox(events, request_id):
+    if not events:
+        return
+    get_db_connection().execute("INSERT INTO event_inbox(events, received_at, request_id) VALUES (?, ?, ?)",
+                                (json.dumps(events, ensure_ascii=False), time.time(), request_id))
+
+#受信箱から取り出してイベントキューへ(リーダーの常駐イベントループ上で動く)
+#DELETE ... RETURNING で取り出すので、切り替わりの瞬間に2プロセスが動いても同じ行は1回しか処理されない
+#取り出すのはキューの空き分だけ(満杯で捨てることが無いよう、入りきらない分は受信箱に残す)
+inbox_poller = None
+
+#取り出したが処理しなかったイベントを元の行idで受信箱に戻す(AUTOINCREMENT なのでidは再利用されず、順番も保たれる)
+def return_to_inbox(inbox_id, events, received_at, request_id):
+    try:
+        get_db_connection().execute("INSERT INTO event_inbox(id, events, received_at, request_id) VALUES (?, ?, ?, ?)",
+                                    (inbox_id, json.dumps(events, ensure_ascii=False),
+                                     time.time() - (time.perf_counter() - received_at), request_id))
+        event_stats["returned"] += len(events)
+    except sqlite3.Error as e:
+        event_stats["dropped"] += len(events)
+        logger.error("イベントを受信箱に戻せませんでした(#%s): %s", inbox_id, e)
+
+def start_inbox_poller():
+    global inbox_poller
+    if inbox_poller is None or inbox_poller.done():
+        inbox_poller = event_loop.create_task(poll_event_inbox())
+
+async def poll_event_inbox():
+    logger.info("イベント受信箱の処理を開始しました")
+    while leader_election.holds_lease():
+        limit = min(INBOX_BATCH, EVENT_QUEUE_MAX - event_queue.qsize()) if EVENT_QUEUE_MAX > 0 else INBOX_BATCH
+        rows = []
+        if limit > 0:
+            try:
+                with db_transaction() as conn:
+                    rows = conn.execute("""
+                    DELETE FROM event_inbox WHERE id IN (SELECT id FROM event_inbox ORDER BY id LIMIT ?)
+                    RETURNING id, events, received_at, request_id
+                    """, (limit,)).fetchall()
+            except sqlite3.Error as e:
+                logger.error("イベント受信箱の読み出しに失敗: %s", e)
+        for inbox_id, events, received_at, request_id in sorted(rows):
+            # 受信からの待ち時間も処理時間に含める
+            _put_events(json.loads(events), time.perf_counter() - max(0.0, time.time() - received_at), request_id, inbox_id)
+        await asyncio.sleep(INBOX_POLL_SEC if len(rows) < max(limit, 1) else 0)
+    logger.info("イベント受信箱の処理を停止しました")
+
+#WSGIサーバーの各ワーカーから呼ぶ(例: gunicorn -w 4 -b 127.0.0.1:5050 "KeyNow:create_app()")
+#--preload は使わないこと(選出用スレッドはワーカーごとに起動する)
+def create_app():
+    global MULTI_WORKER
+    MULTI_WORKER = True
+    leader_election.start()
+    return app
+
+#キュー深さ・処理時間の確認用
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({
+        "events": get_event_stats(),
+        "commands": get_command_stats(),
+        "db": db_stats,
+        "dedupe": {**dedupe_stats, "cached": len(seen_event_ids)},
+        "notifications": {**notifier.stats, "pending_groups": len(notifier.pending)},
+        "outbox": get_outbox_stats(),
+        "line_name_cache": line_name_cache.snapshot(),
+        "roster": {**roster_state, "size": len(roster_index)},
+        "reserve": {**reserve_state, **reserve_calendar.snapshot()},
+        "sheets": google_sheets.snapshot(),
+        "retention": {**retention_stats, "retention_days": HISTORY_RETENTION_DAYS},
+        "usage": usage_stats.snapshot(),
+        "keys": key_registry.snapshot(),
+        "leader": leader_election.snapshot(),
+    })
+
+#Prometheus 用(キュー深さ・保有中の鍵数など出力時に読む値)
+MetricCallback("keynow_event_queue_depth", "処理待ちのWebhook数", lambda: event_queue.qsize() if event_queue else 0)
+MetricCallback("keynow_events_total", "イベント数(received/processed/failed/dropped)",
+               lambda: {(k,): v for k, v in event_stats.items()}, labels=("result",), kind="counter")
+MetricCallback("keynow_dedupe_duplicates_total", "破棄した再送イベント数",
+               lambda: dedupe_stats["duplicates"], kind="counter")
+MetricCallback("keynow_notify_pending_messages", "まとめ送信待ちのグループ通知数",
+               lambda: sum(len(m) for m in notifier.pending.values()))
+MetricCallback("keynow_outbox_pending", "LINE送信キューで送信待ち(再送待ちを含む)の件数",
+               lambda: get_db_connection().execute("SELECT COUNT(*) FROM line_outbox WHERE status='pending'").fetchone()[0])
+MetricCallback("keynow_outbox_dead", "送信を諦めたLINE送信キューの件数(保持期間内)",
+               lambda: get_db_connection().execute("SELECT COUNT(*) FROM line_outbox WHERE status='dead'").fetchone()[0])
+MetricCallback("keynow_scheduler_jobs", "登録中のスケジューラジョブ数",
+               lambda: len(scheduler.get_jobs()) if scheduler is not None else 0)
+MetricCallback("keynow_sheets_up", "Google Sheetsの状態(1=ready, 0.5=degraded, 0=未接続)",
+               lambda: {"ready": 1, "degraded": 0.5}.get(google_sheets.state["status"], 0))
+MetricCallback("keynow_is_leader", "このプロセスがスケジューラのリーダーか(複数ワーカー運用時)",
+               lambda: int(leader_election.is_leader))
+MetricCallback("keynow_event_inbox_depth", "受信箱で処理待ちのWebhook数(複数ワーカー運用時)",
+               lambda: get_db_connection().execute("SELECT COUNT(*) FROM event_inbox").fetchone()[0] if MULTI_WORKER else 0)
+MetricCallback("keynow_keys_held", "貸出中の鍵の数", lambda: len(key_state.snapshot()))
+MetricCallback("keynow_db_busy_errors_total", "BEGIN IMMEDIATE のロック取得失敗数",
+               lambda: db_stats["busy_errors"], kind="counter")
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return app.response_class(render_metrics(), mimetype="text/plain; version=0.0.4")
 
+# Webhook エンドポイント###################################################################################################
+@app.route("/webhook", methods=["POST"])
+def webhook():
+    data = request.json or {}
+    events = data.get("events", [])
+    request_id = uuid.uuid4().hex[:12]
+    token = log_request_id.set(request_id)
+    try:
+        logger.info("Webhook受信: %d件 %s", len(events), LogSnippet([e.get("webhookEventId") for e in events]))
+        if random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+            logger.info("Webhook本文(抜粋): %s", LogSnippet(data))
+        else:
+            logger.debug("Webhook本文: %s", LogSnippet(data))
+
+        # イベントはキューに積むだけで即200を返す(LINEの応答期限対策)。複数ワーカー時は受信箱経由でリーダーが処理
+        if MULTI_WORKER:
+            put_event_inbox(events, request_id)
+        else:
+            enqueue_events(events, request_id)
+    finally:
+        log_request_id.reset(token)
 
-        if text == "履歴削除":
-            c.execute("SELECT group_id FROM groups WHERE group_id=?", (group_id,))
-            if c.fetchone():
-                try:
-                    # 30日前の日付を取得
-                    cutoff_date = (datetime.now() - timedelta(days=10)).strftime("%Y/%m/%d %H:%M:%S")
-                    c.execute("DELETE FROM key_logs WHERE timestamp < ?", (cutoff_date,))
-                    conn.commit()
-                    reply = "10日以前の履歴を削除しました。"
-                    logger.info(f"履歴削除: {cutoff_date} より前の記録を削除しました。")
-                except Exception as e:
-                    reply = f"履歴削除中にエラーが発生しました: {str(e)}"
-                    logger.error(f"履歴削除エラー: {str(e)}")
+    return jsonify({"status": "ok"})
+
+# コマンドルーター#########################################################################################################
+COMMANDS = {}#先頭の語 → コマンド
+PREFIX_COMMANDS = []#(接頭辞, コマンド) 「番号:xxx」のように区切り無しで続くもの
+command_stats = {}
+
+class Command:
+    def __init__(self, label, handler, exact, admin):
+        self.label = label
+        self.handler = handler
+        self.exact = exact  # 引数を取らない
+        self.admin = admin  # 認証済みグループ限定
+
+#ハンドラ登録用デコレータ
+def command(*names, prefix=None, label=None, exact=False, admin=False):
+    def register(handler):
+        entry = Command(label or (names[0] if names else prefix), handler, exact, admin)
+        for name in names:
+            COMMANDS[name] = entry
+        if prefix:
+            PREFIX_COMMANDS.append((prefix, entry))
+        return handler
+    return register
+
+class CommandContext:
+    def __init__(self, event, text, parts):
+        source = event["source"]
+        self.event = event
+        self.reply_token = event.get("replyToken")
+        self.user_id = source.get("userId")
+        self.group_id = source.get("groupId")
+        self.text = text
+        self.parts = parts
+        self.args = parts[1:]
+        # replyTokenが使えない時はトーク(グループ or 個人)へのpushで送る
+        self.fallback_to = self.group_id or self.user_id
+        self.reply_expires_at = event.get("timestamp", time.time() * 1000) / 1000 + REPLY_TOKEN_TTL
+
+    #バッチ処理中はreplyTokenごとに溜めてまとめて送る
+    async def reply(self, *messages):
+        batch = current_batch.get()
+        if batch is not None:
+            batch.replies.setdefault(self.reply_token, []).extend(messages)
+            batch.reply_to[self.reply_token] = (self.fallback_to, self.reply_expires_at)
+            return
+        await send_line_messages(self.reply_token, list(messages), self.fallback_to, self.reply_expires_at)
+
+#テキストを1回だけ分割してコマンドを引く(コマンドでない雑談はここで終わる)
+def resolve_command(text):
+    parts = text.split()
+    if not parts:
+        return None, parts
+    entry = COMMANDS.get(parts[0])
+    if entry is not None:
+        if entry.exact and len(parts) != 1:
+            return None, parts
+        return entry, parts
+    for prefix, entry in PREFIX_COMMANDS:
+        if text.startswith(prefix):
+            return entry, parts
+    return None, parts
+
+def is_group_authenticated(group_id):
+    if not group_id:
+        return False
+    return get_db_connection().execute("SELECT 1 FROM groups WHERE group_id=?", (group_id,)).fetchone() is not None
+
+def record_command_time(label, elapsed_ms, failed):
+    stats = command_stats.setdefault(label, {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+    stats["count"] += 1
+    stats["errors"] += int(failed)
+    stats["total_ms"] += elapsed_ms
+    stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+def get_command_stats():
+    return {label: {**s, "avg_ms": round(s["total_ms"] / s["count"], 1)} for label, s in command_stats.items()}
+
+#イベント処理本体(ワーカーから呼ばれる)
+async def handle_event(event):
+    if event.get("type") != "message" or event["message"].get("type") != "text":
+        return
+
+    text = event["message"]["text"].strip()
+    entry, parts = resolve_command(text)
+    if entry is None:
+        return
+
+    ctx = CommandContext(event, text, parts)
+    logger.info("Command parsed: %s %s", entry.label, parts)
+    started = time.perf_counter()
+    failed = False
+    try:
+        if entry.admin and not is_group_authenticated(ctx.group_id):
+            logger.warning("認証されていないグループから%sが送信されました。", entry.label)
+            await ctx.reply("このグループは認証されていません。")
+            return
+        await entry.handler(ctx)
+    except Exception:
+        failed = True
+        command_errors.inc(entry.label)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        command_seconds.observe(elapsed, entry.label)
+        elapsed_ms = elapsed * 1000
+        record_command_time(entry.label, elapsed_ms, failed)
+        logger.info("コマンド処理時間: %s %.1fms", entry.label, elapsed_ms)
+
+# 学籍番号登録
+@command(prefix="番号:", label="学籍番号登録")
+async def cmd_register(ctx):
+    if not ctx.user_id:
+        return
+    no_upper = ctx.text.split("番号:")[1].strip().upper()
+
+    # 学籍番号チェック
+    if is_user_registered(ctx.user_id):
+        reply = "すでに登録済みです。"
+    else:
+        try:
+            # 名簿ミラーから学籍番号を検索
+            name = await asyncio.to_thread(lookup_student_name, no_upper)
+            if name is not None:
+                db_write("INSERT INTO users(line_id, student_no, name) VALUES (?, ?, ?)", (ctx.user_id, no_upper, name))
+                batch = current_batch.get()
+                if batch is not None:
+                    batch.users[ctx.user_id] = name
+                reply = f"登録完了：{name}（{no_upper}）"
             else:
-                reply = "このグループは認証されていません。"
-                logger.warning("認証されていないグループから履歴削除が送信されました。")
+                reply = "学籍番号が見つかりません。"
+        except SheetsUnavailable:
+            reply = "名簿に接続できないため確認できませんでした。しばらくしてからもう一度送ってください。"
+        except Exception as e:
+            reply = f"エラーが発生しました：{str(e)}"
+    await ctx.reply(reply)
+
+#グループ認証
+@command(prefix=AUTH_CODE, label="グループ認証")
+async def cmd_auth_group(ctx):
+    if not ctx.group_id:
+        return
+    db_write("INSERT OR IGNORE INTO groups(group_id) VALUES (?)", (ctx.group_id,))
+    await ctx.reply("このグループを認証済みに登録しました。")
+
+#認証グループ削除
+@command("OPUS&Delete", exact=True)
+async def cmd_delete_group(ctx):
+    if not ctx.group_id:
+        return
+    db_write("DELETE FROM groups WHERE group_id=?", (ctx.group_id,))
+    await ctx.reply("このグループを認証済みグループから削除しました。")
+
+# 鍵管理（借りる、返却、引き継ぎ）
+@command("借りる", "返却", "引き継ぎ", label="鍵操作")
+async def cmd_key_action(ctx):
+    if not ctx.args:
+        return
+    action = ctx.parts[0]
+    user_id = ctx.user_id
+    logger.info("メッセージを受信: %s, 鍵種類: %s", action, ctx.args)
+    # 鍵・別名・組(「両方」など)をいくつでも指定でき、まとめて1回で処理する
+    keys_to_process, unknown = key_registry.resolve(ctx.args)
+    if unknown or not keys_to_process:
+        example = "・".join(key_registry.keys[:2])
+        await ctx.reply(f"鍵の種類は{key_registry.describe()}から指定してください。(複数指定可 例: {action} {example})")
+        return
+    logger.info("Keys to process: %s", keys_to_process)
+    #このバッチで登録したばかりなら登録を先に確定する(書けなかった場合は未登録として扱う)
+    batch = current_batch.get()
+    if batch is not None and user_id in batch.users:
+        commit_batch_writes(batch)
+    #学籍番号登録チェック
+    if not is_user_registered(user_id):
+        await ctx.reply("学籍番号が登録されていません。まず「番号:あなたの学籍番号」で登録してください。")
+        return
+
+    when = datetime.now()
+    now = when.strftime("%Y/%m/%d %H:%M")
+    label = "・".join(keys_to_process)
+    user_name = get_user_name(user_id)
+    log = (action, label, user_name, user_id)
+    try:
+        if action == "借りる":
+            # 予約の時間指定がある日は時間帯の中でだけ借りられる
+            closed = [k for k in keys_to_process if reserve_calendar.is_closed(k, when)]
+            if closed:
+                lines = [f"{'・'.join(closed)} は予約の時間帯外のため借りられません。"]
+                for k in closed:
+                    window = reserve_calendar.next_window(k, when)
+                    if window:
+                        lines.append(f"{k} の次に借りられる時間: {format_window(window)}")
+                logger.warning("借りる操作失敗: %s は予約の時間帯外です", "・".join(closed))
+                await ctx.reply("\n".join(lines))
+                return
+            ok, current = key_state.borrow(keys_to_process, user_id, now, log)
+            if not ok:
+                taken = "・".join(k for k, holder in current.items() if holder is not None)
+                if len(keys_to_process) > 1:
+                    reply = f"{label} のうち {taken} が既に借りられています。"
+                else:
+                    reply = f"{label} は既に借りられています。"
+                logger.warning("借りる操作失敗: %s は既に借りられています: %s", label, current)
+                await ctx.reply(reply)
+                return
+        elif action == "返却":
+            ok, current = key_state.release(keys_to_process, user_id, log)
+            if not ok:
+                owners = set(current.values())
+                if len(keys_to_process) > 1 and None not in owners and len(owners) != 1:
+                    reply = f"{label} は同じ所有者でないため、同時に返却できません。"
+                else:
+                    reply = f"{label} は借りられていません、または他のユーザーが所有しています。"
+                logger.warning("返却操作失敗: %s の保有者が一致しません: %s", label, current)
+                await ctx.reply(reply)
+                return
+        else:
+            ok, current = key_state.handover(keys_to_process, user_id, now, log)
+            if not ok:
+                owners = set(current.values())
+                if len(keys_to_process) > 1 and None not in owners and len(owners) != 1:
+                    reply = f"{label} は同じ所有者でないため、同時に引き継ぎできません。"
+                else:
+                    reply = f"{label} は現在借りられていません。"
+                logger.warning("引き継ぎ操作失敗: %s: %s", label, current)
+                await ctx.reply(reply)
+                return
+
+        line_name = await get_line_name(user_id)
+        display = f"{user_name}さん（LINE名:{line_name}）"
+        logger.info("Logged action: %s - %s by %s", action, label, user_name)
+
+        if action == "借りる":
+            reply = f"{label} を {display} が借りました。"
+        elif action == "返却":
+            reply = f"{label} を {display} が返却しました。"
+        else:
+            reply = f"{label} を {display} に引き継ぎました。"
+        logger.info("%s操作成功: %s", action, reply)
+        if action == "返却":
+            await ctx.reply(reply)
+        else:
+            deadline = min(get_loan_deadline(k, now) for k in keys_to_process)
+            await ctx.reply(f"{reply}\n返却期限は {format_deadline(deadline, when)} です。")
+        await push_to_authenticated_groups(reply)
 
-            conn.close()
-            asyncio.run(send_line_message(reply_token, reply))
-            continue
+    except Exception as e:
+        error_message = f"操作中にエラーが発生しました: {str(e)}"
+        logger.error(error_message)
+        await ctx.reply(error_message)
+
+# 鍵確認
+@command("鍵確認", exact=True)
+async def cmd_key_status(ctx):
+    holders = key_state.snapshot()
+    if not holders:
+        reply = "現在、貸出中の鍵はありません。"
+    else:
+        lines = []
+        for key_name, (holder_id, borrow_time) in holders.items():
+            holder_name = get_user_name(holder_id)
+            line_name = await get_line_name(holder_id)
+            display = f"{holder_name}さん（LINE名:{line_name}）"
+            lines.append(f"{key_name} → {display} ({borrow_time})")
+        reply = "\n".join(lines)
+    await ctx.reply(reply)
+
+# 予約確認(今日の時間帯と次に借りられる時間)
+@command("予約確認")
+async def cmd_reserve_status(ctx):
+    keys, unknown = key_registry.resolve(ctx.args) if ctx.args else (key_registry.keys, [])
+    if unknown or not keys:
+        await ctx.reply(f"鍵の種類は{key_registry.describe()}から指定してください。")
+        return
+    when = datetime.now()
+    loans = key_state.snapshot()
+    lines = []
+    for key_name in keys:
+        window = reserve_calendar.next_window(key_name, when)
+        if key_name in loans:
+            deadline = get_loan_deadline(key_name, loans[key_name][1])
+            lines.append(f"{key_name}: 貸出中(返却期限 {format_deadline(deadline, when)})")
+        elif window is None:
+            lines.append(f"{key_name}: {RESERVE_LOOKAHEAD_DAYS}日先まで借りられる時間帯はありません")
+        elif window[0] <= when:
+            lines.append(f"{key_name}: 今借りられます(返却期限 {window[1].strftime('%H:%M')})")
+        else:
+            lines.append(f"{key_name}: 次に借りられる時間 {format_window(window)}")
+    await ctx.reply("\n".join(lines))
+
+@command("履歴確認", admin=True)
+async def cmd_history(ctx):
+    await ctx.reply(*await history_reply_messages(ctx.args))
+
+@command("リセット鍵情報", exact=True, admin=True)
+async def cmd_reset_keys(ctx):
+    try:
+        await human_reset_key_holders()
+        reply = "鍵の保有情報をリセットしました。"
+        logger.info("鍵保有情報リセット実行")
+    except Exception as e:
+        reply = f"リセット中にエラーが発生しました: {str(e)}"
+        logger.error("リセット失敗: %s", e)
+    await ctx.reply(reply)
 
+@command("履歴削除", exact=True, admin=True)
+async def cmd_delete_history(ctx):
+    try:
+        # 定期処理と同じく日次集計に反映してから保持期間より前を削除
+        trimmed = await asyncio.to_thread(run_history_retention, False)
+        reply = f"{HISTORY_RETENTION_DAYS}日以前の履歴を削除しました。({trimmed}件、日別の件数は集計に残ります)"
+        logger.info("履歴削除: %s日より前の記録を %s 件削除しました。", HISTORY_RETENTION_DAYS, trimmed)
+    except Exception as e:
+        reply = f"履歴削除中にエラーが発生しました: {str(e)}"
+        logger.error("履歴削除エラー: %s", e)
+    await ctx.reply(reply)
 
-    return jsonify({"status": "ok"})
+#新しい履歴を貸出区間に反映してから集計する(保持処理の実行中は反映を待たない)
+def load_usage_stats(days):
+    if retention_lock.acquire(blocking=False):
+        try:
+            collect_key_loans()
+        finally:
+            retention_lock.release()
+    return usage_stats.summary(days)
+
+@command("利用統計", admin=True)
+async def cmd_usage_stats(ctx):
+    days = USAGE_STATS_DAYS
+    if ctx.args:
+        arg = ctx.args[0].removesuffix("日")
+        if not arg.isdigit() or not 0 < int(arg) <= USAGE_STATS_MAX_DAYS:
+            await ctx.reply("期間は日数で指定してください。(例: 利用統計 90)")
+            return
+        days = int(arg)
+    try:
+        reply = usage_stats_reply(await asyncio.to_thread(load_usage_stats, days), days)
+    except Exception as e:
+        reply = f"利用統計の集計中にエラーが発生しました: {str(e)}"
+        logger.error("利用統計エラー: %s", e)
+    await ctx.reply(reply)
 
 #鍵管理処理内での名前取得
 def get_user_name(user_id):
-    conn = sqlite3.connect(DB_PATH)
+    batch = current_batch.get()
+    if batch is not None and user_id in batch.users:
+        return batch.users[user_id]
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("SELECT name FROM users WHERE line_id=?", (user_id,))
     result = c.fetchone()
-    conn.close()
     if result:
         return result[0]
     return "不明なユーザー"
 
+#LINE表示名キャッシュ(LRU + TTL、失敗時は短いTTLで負キャッシュ、任意でSQLiteに永続化)
+LINE_NAME_CACHE_SIZE = int(config.get("line_name_cache_size", 512))
+LINE_NAME_TTL = float(config.get("line_name_ttl", 6 * 3600))#秒
+LINE_NAME_NEGATIVE_TTL = float(config.get("line_name_negative_ttl", 300))#秒
+LINE_NAME_PERSIST = bool(config.get("line_name_persist", True))
+
+class LineNameCache:
+    def __init__(self, maxsize: int, persist: bool):
+        self.maxsize = maxsize
+        self.persist = persist
+        self.entries = OrderedDict()  # user_id -> (display_name or None, expires_at)
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "negative_hits": 0, "persistent_hits": 0}
+
+    def get(self, user_id):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry and entry[1] > now:
+                self.entries.move_to_end(user_id)
+                self.stats["hits" if entry[0] is not None else "negative_hits"] += 1
+                return True, entry[0]
+            if entry:
+                del self.entries[user_id]
+        if self.persist:
+            conn = get_db_connection()
+            row = conn.execute("SELECT display_name, expires_at FROM line_name_cache WHERE user_id=?",
+                               (user_id,)).fetchone()
+            if row and row[1] > now:
+                self._remember(user_id, row[0], row[1])
+                with self.lock:
+                    self.stats["persistent_hits"] += 1
+                return True, row[0]
+        with self.lock:
+            self.stats["misses"] += 1
+        return False, None
+
+    def put(self, user_id, display_name):
+        ttl = LINE_NAME_TTL if display_name is not None else LINE_NAME_NEGATIVE_TTL
+        expires_at = time.time() + ttl
+        self._remember(user_id, display_name, expires_at)
+        if self.persist and display_name is not None:
+            conn = get_db_connection()
+            conn.execute("INSERT OR REPLACE INTO line_name_cache(user_id, display_name, expires_at) VALUES (?, ?, ?)",
+                         (user_id, display_name, expires_at))
+
+    def _remember(self, user_id, display_name, expires_at):
+        with self.lock:
+            self.entries[user_id] = (display_name, expires_at)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def snapshot(self):
+        with self.lock:
+            total = self.stats["hits"] + self.stats["negative_hits"] + self.stats["persistent_hits"] + self.stats["misses"]
+            hit_rate = round(1 - self.stats["misses"] / total, 3) if total else None
+            return {**self.stats, "size": len(self.entries), "hit_rate": hit_rate}
+
+line_name_cache = LineNameCache(LINE_NAME_CACHE_SIZE, LINE_NAME_PERSIST)
+
 #LINE表示名取得関数
 async def get_line_name(user_id: str) -> str:
-    headers = {
-        "Authorization": f"Bearer {LINE_ACCESS_TOKEN}"
-    }
-    url = f"https://api.line.me/v2/bot/profile/{user_id}"
-    async with httpx.AsyncClient(timeout=5.0) as client:
-        try:
-            response = await client.get(url, headers=headers)
-            if response.status_code == 200:
-                return response.json().get("displayName", "")
-            else:
-                logger.warning(f"LINEプロフィール取得失敗（{user_id}）: {response.status_code}")
-                return ""
-        except Exception as e:
-            logger.error(f"LINEプロフィール取得エラー（{user_id}）: {str(e)}")
-            return ""
+    cached, display_name = line_name_cache.get(user_id)
+    if cached:
+        return display_name or ""
+    display_name = await fetch_line_name(user_id)
+    line_name_cache.put(user_id, display_name)
+    return display_name or ""
+
+#プロフィールAPI呼び出し(失敗時None)
+async def fetch_line_name(user_id: str):
+    url = f"{LINE_API_BASE}/v2/bot/profile/{user_id}"
+    try:
+        response = await line_request("profile", "GET", url, timeout=5.0)
+        if response.status_code == 200:
+            return response.json().get("displayName", "")
+        else:
+            logger.warning("LINEプロフィール取得失敗（%s）: %s", user_id, response.status_code)
+            return None
+    except Exception as e:
+        logger.error("LINEプロフィール取得エラー（%s）: %s", user_id, e)
+        return None
+
+#認証済みのグループへのメッセージ送信(通常はまとめ送信、期限切れ等は priority="urgent" で即時)
+async def push_to_authenticated_groups(message: str, priority="normal"):
+    batch = current_batch.get()
+    if batch is not None:
+        batch.group_messages.append((message, priority, batch.index))
+        return {}
+    return await notifier.submit([message], priority)
 
-#認証済みのグループへのメッセージ送信
-async def push_to_authenticated_groups(message: str):
-    conn = sqlite3.connect(DB_PATH)
+def get_authenticated_group_ids():
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("SELECT group_id FROM groups")
-    groups = c.fetchall()
-    conn.close()
-
-    for group in groups:
-        group_id = group[0]
-        await push_line_message(group_id, message)
+    return [row[0] for row in c.fetchall()]
 
 #ユーザー登録確認
 def is_user_registered(user_id):
-    conn = sqlite3.connect(DB_PATH)
+    batch = current_batch.get()
+    if batch is not None and user_id in batch.users:
+        return True
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("SELECT 1 FROM users WHERE line_id=?", (user_id,))
     result = c.fetchone()
-    conn.close()
     return result is not None
 
 #鍵のリセット処理
 async def reset_key_holders():
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-
         # 鍵保有情報を全て削除
-        c.execute("DELETE FROM key_holders")
-        conn.commit()
-        conn.close()
+        key_state.clear()
 
         # リセット完了通知をグループに送信
         message = "24時を過ぎました。(若しくは手動操作により)本日の鍵保有情報をリセットしました。"
         await push_to_authenticated_groups(message)
         logger.info("24時リセット完了(若しくは手動リセット完了)全ての鍵保有情報を削除しました。")
     except Exception as e:
-        logger.error(f"リセット処理でエラーが発生しました: {str(e)}")
+        logger.error("リセット処理でエラーが発生しました: %s", e)
 
 
 async def human_reset_key_holders():
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-
         # 鍵保有情報を全て削除
-        c.execute("DELETE FROM key_holders")
-        conn.commit()
-        conn.close()
+        key_state.clear()
 
         logger.info("手動操作により全ての鍵保有情報を削除しました。")
     except Exception as e:
-        logger.error(f"リセット処理でエラーが発生しました: {str(e)}")
+        logger.error("リセット処理でエラーが発生しました: %s", e)
 
 
 
@@ -728,12 +3181,14 @@ async def human_reset_key_holders():
 # Flask実行
 if __name__ == "__main__":
     try:
-        # スケジューラを非同期で開始
+        # Google Sheets への接続・イベントワーカー・スケジューラを非同期で開始(Flaskは接続を待たずに受付開始)
+        google_sheets.start()
+        start_event_workers()
         start_scheduler()
         logger.info("Flask and APScheduler starting...")
         app.run(host="127.0.0.1", port=5050, debug=False)
     except Exception as e:
-        logger.error(f"Error starting Flask app: {str(e)}")
+        logger.error("Error starting Flask app: %s", e)
 
 
 
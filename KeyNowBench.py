@@ -0,0 +1,417 @@
+import os
+import sys
+import json
+import time
+import types
+import random
+import uuid
+import argparse
+import tempfile
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# KeyNow 負荷試験ハーネス
+# LINE API と Google Sheets をローカルのスタブに置き換え、Webhookへの投稿を再生して
+# 応答時間・処理時間・スループット・SQLiteのロック待ち・スケジューラジョブの所要時間を計測する。
+# 例: python KeyNowBench.py --requests 2000 --concurrency 8 --line-latency-ms 80 --line-error-rate 0.02
+
+AUTH_CODE = "####"
+GROUP_ID = "Cbenchgroup0000000000000000000000"
+KEYS = ["音倉", "音練", "両方", "音倉 音練"]
+
+
+# LINE API スタブ#########################################################################################################
+class LineStub:
+    def __init__(self, latency_ms, jitter_ms, error_rate, rate_limit_rate):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.calls = Counter()
+        self.errors = Counter()
+        self.lock = threading.Lock()
+
+    def delay(self):
+        time.sleep(max(0.0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000)
+
+    def record(self, endpoint, status):
+        with self.lock:
+            self.calls[endpoint] += 1
+            if status != 200:
+                self.errors[f"{endpoint}:{status}"] += 1
+
+
+class LineStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def _endpoint(self):
+        if self.path.startswith("/v2/bot/profile/"):
+            return "profile"
+        return self.path.rsplit("/", 1)[-1]
+
+    def _respond(self, body=None):
+        stub = self.server.stub
+        endpoint = self._endpoint()
+        stub.delay()
+        roll = random.random()
+        if roll < stub.rate_limit_rate:
+            status, headers, body = 429, {"Retry-After": "1"}, {"message": "rate limited"}
+        elif roll < stub.rate_limit_rate + stub.error_rate:
+            status, headers, body = 500, {}, {"message": "injected error"}
+        else:
+            status, headers = 200, {}
+        stub.record(endpoint, status)
+        data = json.dumps(body or {}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._respond()
+
+    def do_GET(self):
+        user_id = self.path.rsplit("/", 1)[-1]
+        self._respond({"displayName": f"LINE-{user_id[-4:]}"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_line_stub(stub):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), LineStubHandler)
+    server.daemon_threads = True
+    server.stub = stub
+    threading.Thread(target=server.serve_forever, name="line-stub", daemon=True).start()
+    return server
+
+
+# Google Sheets / Drive スタブ############################################################################################
+class SheetsStub:
+    def __init__(self, latency_ms, error_rate):
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+        time.sleep(self.latency_ms / 1000)
+        if random.random() < self.error_rate:
+            raise RuntimeError(f"injected Sheets error ({name})")
+
+
+class FakeCell:
+    def __init__(self, row, col, value):
+        self.row = row
+        self.col = col
+        self.value = value
+
+
+class FakeWorksheet:
+    def __init__(self, stub, rows):
+        self.stub = stub
+        self.rows = rows
+
+    def findall(self, query):
+        self.stub.call("findall")
+        return [FakeCell(r + 1, c + 1, v) for r, row in enumerate(self.rows) for c, v in enumerate(row) if v == query]
+
+    def cell(self, row, col):
+        self.stub.call("cell")
+        try:
+            return FakeCell(row, col, self.rows[row - 1][col - 1])
+        except IndexError:
+            return FakeCell(row, col, "")
+
+    def get_all_values(self):
+        self.stub.call("get_all_values")
+        return [list(row) for row in self.rows]
+
+
+class FakeSpreadsheet:
+    def __init__(self, sheet_id, worksheets):
+        self.id = sheet_id
+        self.worksheets = worksheets
+
+    def worksheet(self, name):
+        return self.worksheets[name]
+
+
+class FakeDriveFile(dict):
+    def __init__(self, stub):
+        super().__init__()
+        self.stub = stub
+
+    def FetchMetadata(self, fields=None):
+        self.stub.call("drive_metadata")
+        self["modifiedDate"] = "2000-01-01T00:00:00.000Z"
+
+
+#gspread / oauth2client / pydrive を差し替える(KeyNow の import より前に呼ぶ)
+def install_google_stubs(stub, users):
+    roster = [["学籍番号", "名前"]] + [[student_no(i), f"部員{i}"] for i in range(users)]
+    tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y/%m/%d")
+    reserve = [["日付", "時間", "鍵"], [tomorrow, "14-18", ""], [tomorrow, "18:30-20", "音練"]]  # 今日は指定なし(いつでも借りられる)
+    spreadsheets = {
+        "名簿DB": FakeSpreadsheet("roster-sheet", {"名簿": FakeWorksheet(stub, roster)}),
+        "KeyNow": FakeSpreadsheet("reserve-sheet", {"予約": FakeWorksheet(stub, reserve)}),
+    }
+
+    gspread = types.ModuleType("gspread")
+    gspread.authorize = lambda creds: types.SimpleNamespace(open=lambda name: spreadsheets[name])
+    service_account = types.ModuleType("oauth2client.service_account")
+    service_account.ServiceAccountCredentials = types.SimpleNamespace(
+        from_json_keyfile_name=lambda *args, **kwargs: object())
+    pydrive_auth = types.ModuleType("pydrive.auth")
+    pydrive_auth.GoogleAuth = lambda: types.SimpleNamespace(credentials=None)
+    pydrive_drive = types.ModuleType("pydrive.drive")
+    pydrive_drive.GoogleDrive = lambda gauth: types.SimpleNamespace(CreateFile=lambda meta: FakeDriveFile(stub))
+    sys.modules.update({
+        "gspread": gspread,
+        "oauth2client": types.ModuleType("oauth2client"),
+        "oauth2client.service_account": service_account,
+        "pydrive": types.ModuleType("pydrive"),
+        "pydrive.auth": pydrive_auth,
+        "pydrive.drive": pydrive_drive,
+    })
+
+
+# Webhook 本文生成########################################################################################################
+def student_no(i):
+    return f"BENCH{i:05d}"
+
+
+def user_id_of(i):
+    return f"U{i:032d}"
+
+
+def text_event(text, user_id, group_id=GROUP_ID):
+    source = {"type": "group", "groupId": group_id, "userId": user_id} if group_id else {"type": "user", "userId": user_id}
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "webhookEventId": uuid.uuid4().hex.upper(),
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": uuid.uuid4().hex,
+        "source": source,
+        "message": {"type": "text", "id": str(random.randrange(10 ** 17)), "text": text},
+    }
+
+
+#実運用に近い割合でコマンドを混ぜる
+def random_event(users):
+    user_id = user_id_of(random.randrange(users))
+    roll = random.random()
+    if roll < 0.20:
+        return text_event(f"借りる {random.choice(KEYS)}", user_id)
+    if roll < 0.40:
+        return text_event(f"返却 {random.choice(KEYS)}", user_id)
+    if roll < 0.50:
+        return text_event(f"引き継ぎ {random.choice(KEYS)}", user_id)
+    if roll < 0.60:
+        return text_event("鍵確認", user_id)
+    if roll < 0.65:
+        return text_event("履歴確認", user_id)
+    if roll < 0.67:
+        return text_event("履歴確認 集計", user_id)
+    if roll < 0.70:
+        return text_event(f"番号:{student_no(random.randrange(users))}", user_id, group_id=None)
+    return text_event(random.choice(["おつかれさまです", "今日何時まで？", "了解です", "🙏"]), user_id)
+
+
+def webhook_body(events):
+    return {"destination": "Ubenchbot", "events": events}
+
+
+# 集計#####################################################################################################################
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def pick(p):
+        return round(values[min(len(values) - 1, int(len(values) * p))], 2)
+
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(values[-1], 2)}
+
+
+def time_job(func, runs):
+    durations = []
+    errors = 0
+    for _ in range(runs):
+        started = time.perf_counter()
+        try:
+            func()
+        except Exception:
+            errors += 1
+        durations.append((time.perf_counter() - started) * 1000)
+    return {**percentiles(durations), "runs": runs, "errors": errors}
+
+
+#予約の時間外に借りた・引き継いだ鍵の返却期限が過去にならない(すぐ期限切れ通知が出ない)ことの確認
+#戻り値: 期待と違った (時刻, 返却期限, 期待値) のリスト
+def check_after_hours_deadlines(keynow):
+    day = datetime.now().date() + timedelta(days=30)  # 予約指定あり(14-18)、翌日以降は指定なし
+    calendar = keynow.ReserveCalendar()
+    calendar.update(keynow.parse_reserve_rows([[day.strftime("%Y/%m/%d"), "14-18"]]))
+    at = lambda days, clock: datetime.combine(day + timedelta(days=days), datetime.strptime(clock, "%H:%M").time())
+    cases = [
+        (at(0, "15:00"), at(0, "18:00")),  # 時間帯の中
+        (at(0, "10:00"), at(0, "18:00")),  # 時間帯の前
+        (at(0, "19:00"), at(1, "20:55")),  # 時間帯が全て終わった後 → 次に借りられる時間帯の終わり
+        (at(1, "12:00"), at(1, "20:55")),  # 指定なしの日
+        (at(1, "22:00"), at(2, "20:55")),  # 指定なしの日の 20:55 以降
+    ]
+    return [(when, calendar.deadline("音倉", when), expected) for when, expected in cases
+            if calendar.deadline("音倉", when) != expected]
+
+
+#LINE送信キューが空になるまで待つ(戻り値: 待った秒数)
+def wait_outbox(keynow, timeout=120):
+    started = time.perf_counter()
+    while keynow.get_outbox_stats()["pending"] and time.perf_counter() - started < timeout:
+        time.sleep(0.05)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="KeyNow オフライン負荷試験")
+    parser.add_argument("--requests", type=int, default=1000, help="Webhook投稿回数")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時投稿数")
+    parser.add_argument("--max-events", type=int, default=3, help="1投稿あたりの最大イベント数")
+    parser.add_argument("--users", type=int, default=50, help="部員数")
+    parser.add_argument("--line-latency-ms", type=float, default=50.0)
+    parser.add_argument("--line-jitter-ms", type=float, default=20.0)
+    parser.add_argument("--line-error-rate", type=float, default=0.0, help="500を返す割合")
+    parser.add_argument("--line-429-rate", type=float, default=0.0, help="429を返す割合")
+    parser.add_argument("--sheets-latency-ms", type=float, default=300.0)
+    parser.add_argument("--sheets-error-rate", type=float, default=0.0)
+    parser.add_argument("--notify-window-sec", type=float, default=0.0, help="管理グループ通知のまとめ時間")
+    parser.add_argument("--job-runs", type=int, default=5, help="スケジューラジョブの実行回数")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    parser.add_argument("--metrics", help="終了時の /metrics を保存するパス")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    json_path = os.path.abspath(args.json) if args.json else None
+    metrics_path = os.path.abspath(args.metrics) if args.metrics else None
+
+    line_stub = LineStub(args.line_latency_ms, args.line_jitter_ms, args.line_error_rate, args.line_429_rate)
+    server = start_line_stub(line_stub)
+    sheets_stub = SheetsStub(args.sheets_latency_ms, args.sheets_error_rate)
+    install_google_stubs(sheets_stub, args.users)
+
+    # 作業用ディレクトリにDB・ログ・設定を置く
+    workdir = tempfile.mkdtemp(prefix="keynow-bench-")
+    os.chdir(workdir)
+    with open("line.json", "w", encoding="utf-8") as f:
+        json.dump({
+            "line_bot_token": "bench-token",
+            "auth_code": AUTH_CODE,
+            "line_api_base": f"http://127.0.0.1:{server.server_address[1]}",
+            "notify_window_sec": args.notify_window_sec,
+            "line_name_persist": True,
+        }, f)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import KeyNow
+    from collections import deque
+    KeyNow.event_latencies = deque(maxlen=args.requests * args.max_events + 1000)
+
+    KeyNow.google_sheets.start()
+    if not KeyNow.google_sheets.ready.wait(30):
+        sys.exit(f"Sheetsスタブへの接続に失敗: {KeyNow.google_sheets.snapshot()}")
+    mismatches = check_after_hours_deadlines(KeyNow)
+    if mismatches:
+        sys.exit(f"時間外の返却期限が不正: {mismatches}")
+
+    client = KeyNow.app.test_client()
+    # 準備: グループ認証と部員の登録
+    client.post("/webhook", json=webhook_body([text_event(AUTH_CODE, user_id_of(0))]))
+    for i in range(args.users):
+        client.post("/webhook", json=webhook_body([text_event(f"番号:{student_no(i)}", user_id_of(i), group_id=None)]))
+    KeyNow.run_coroutine(KeyNow.event_queue.join())
+    wait_outbox(KeyNow)
+    KeyNow.event_latencies.clear()
+
+    bodies = [webhook_body([random_event(args.users) for _ in range(random.randint(1, args.max_events))])
+              for _ in range(args.requests)]
+    local = threading.local()
+
+    def post(body):
+        if not hasattr(local, "client"):
+            local.client = KeyNow.app.test_client()
+        started = time.perf_counter()
+        resp = local.client.post("/webhook", json=body)
+        return (time.perf_counter() - started) * 1000, resp.status_code
+
+    print(f"投稿開始: {args.requests} 件 (同時 {args.concurrency}) 作業ディレクトリ {workdir}")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(post, bodies))
+    posted = time.perf_counter() - started
+    KeyNow.run_coroutine(KeyNow.event_queue.join())
+    drained = time.perf_counter() - started
+    outbox_seconds = wait_outbox(KeyNow)
+
+    total_events = sum(len(b["events"]) for b in bodies)
+    report = {
+        "requests": args.requests,
+        "events": total_events,
+        "ack_ms": percentiles([r[0] for r in results]),
+        "non_200": sum(1 for r in results if r[1] != 200),
+        "processing_ms": percentiles(list(KeyNow.event_latencies)),
+        "post_seconds": round(posted, 2),
+        "drain_seconds": round(drained, 2),
+        "throughput_events_per_sec": round(total_events / drained, 1),
+        "outbox_drain_seconds": round(outbox_seconds, 2),
+        "stats": KeyNow.app.test_client().get("/stats").get_json(),
+    }
+
+    # スケジューラジョブを同じ環境で実行(期限切れ通知が出るよう貸出中の鍵は前日に借りたことにする)
+    yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y/%m/%d %H:%M")
+    with KeyNow.key_state.lock:
+        KeyNow.key_state.holders = {k: (holder, yesterday) for k, (holder, _) in KeyNow.key_state.holders.items()}
+    report["jobs_ms"] = {
+        "run_notify_overdue_keys": time_job(KeyNow.run_notify_overdue_keys, args.job_runs),
+        "refresh_roster": time_job(lambda: KeyNow.refresh_roster(force=True), args.job_runs),
+        "refresh_reserve_schedule": time_job(lambda: KeyNow.refresh_reserve_schedule(force=True), args.job_runs),
+        "purge_webhook_events": time_job(KeyNow.purge_webhook_events, args.job_runs),
+        "run_reset_key_holders": time_job(KeyNow.run_reset_key_holders, 1),
+    }
+    wait_outbox(KeyNow)
+    report["line_calls"] = dict(line_stub.calls)
+    report["line_errors"] = dict(line_stub.errors)
+    report["sheets_calls"] = dict(sheets_stub.calls)
+
+    db = report["stats"]["db"]
+    print(f"応答(ms)   : {report['ack_ms']}")
+    print(f"処理(ms)   : {report['processing_ms']}")
+    print(f"スループット: {report['throughput_events_per_sec']} events/s ({total_events} events / {report['drain_seconds']}s)")
+    print(f"SQLite     : トランザクション {db['transactions']} / ロック待ち最大 {db['lock_wait_ms_max']:.1f}ms"
+          f" / 合計 {db['lock_wait_ms_total']:.1f}ms / busy {db['busy_errors']}")
+    print(f"LINE呼出   : {report['line_calls']} エラー {report['line_errors']}")
+    print(f"送信キュー : {report['stats']['outbox']} / 処理完了後 {report['outbox_drain_seconds']}s で送信完了")
+    print(f"Sheets呼出 : {report['sheets_calls']}")
+    for name, stats in report["jobs_ms"].items():
+        print(f"ジョブ {name}: {stats}")
+    if metrics_path:
+        with open(metrics_path, "w", encoding="utf-8") as f:
+            f.write(KeyNow.app.test_client().get("/metrics").get_data(as_text=True))
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()